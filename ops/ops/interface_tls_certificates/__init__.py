@@ -1,3 +1,22 @@
-from .requires import CertificatesRequires
+"""Implementation of the tls-certificates interface for the operator framework.
 
-__all__ = ["CertificatesRequires"]
+The modules are only imported when their names are first used.
+"""
+
+__all__ = ["CertificatesProvides", "CertificatesRequires", "write_certs"]
+
+
+def __getattr__(name):
+    if name == "CertificatesProvides":
+        from .provides import CertificatesProvides
+
+        return CertificatesProvides
+    if name == "CertificatesRequires":
+        from .requires import CertificatesRequires
+
+        return CertificatesRequires
+    if name == "write_certs":
+        from .files import write_certs
+
+        return write_certs
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
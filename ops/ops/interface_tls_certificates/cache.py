@@ -0,0 +1,24 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Caching of decoded relation data by revision."""
+
+import functools
+
+
+def revision_cached(method):
+    """Cache a property until the relation data revision changes.
+
+    The owner must have `_revision` and `_cache` attributes, and bump the
+    revision whenever the relation data may have changed.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def cached(self):
+        revision, value = self._cache.get(name, (None, None))
+        if revision != self._revision:
+            value = method(self)
+            self._cache[name] = (self._revision, value)
+        return value
+
+    return property(cached)
@@ -0,0 +1,126 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Key options, SANs, and local keys and CSRs for the tls-certificates relation.
+
+Generating keys requires the optional `cryptography` package, which is only
+imported when a key or CSR is actually generated.
+"""
+
+import ipaddress
+from typing import Dict, Iterable, List, Optional, Union
+
+# supported key types, and their default size
+KEY_TYPES = {
+    "rsa": 2048,
+    "ecdsa": 256,
+    "ed25519": None,
+}
+
+
+def key_options(
+    key_type: Optional[str] = None, key_size: Optional[int] = None
+) -> Dict[str, Union[str, int]]:
+    """Validate the optional key type and size of a request.
+
+    Returns the fields to include in the request.
+    """
+    if key_type is None:
+        if key_size is not None:
+            raise ValueError("key_size requires a key_type")
+        return {}
+    if key_type not in KEY_TYPES:
+        raise ValueError(f"Unknown key_type: {key_type}")
+    options: Dict[str, Union[str, int]] = {"key_type": key_type}
+    if key_size is not None:
+        options["key_size"] = int(key_size)
+    return options
+
+
+def canonicalize_sans(sans: Optional[Iterable[str]], common_name=None) -> List[str]:
+    """Return the canonical form of a list of subject alternative names.
+
+    DNS names are lower-cased without any trailing dot, IP addresses are
+    normalized, and duplicates removed.  If the `common_name` is given, it is
+    folded out of the result.
+    """
+    canonical = set()
+    for san in sans or []:
+        san = str(san).strip()
+        try:
+            san = str(ipaddress.ip_address(san))
+        except ValueError:
+            san = san.lower().rstrip(".")
+        if san:
+            canonical.add(san)
+    if common_name:
+        canonical.discard(str(common_name).strip().lower().rstrip("."))
+    return sorted(canonical)
+
+
+def generate_private_key(key_type: str = "rsa", key_size: Optional[int] = None) -> str:
+    """Generate a new private key of the given type and size, returned as PEM."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+    key_options(key_type, key_size)
+    key_size = key_size or KEY_TYPES[key_type]
+    if key_type == "rsa":
+        key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    elif key_type == "ecdsa":
+        curves = {256: ec.SECP256R1, 384: ec.SECP384R1, 521: ec.SECP521R1}
+        if key_size not in curves:
+            raise ValueError(f"Unsupported ecdsa key_size: {key_size}")
+        key = ec.generate_private_key(curves[key_size]())
+    else:
+        key = ed25519.Ed25519PrivateKey.generate()
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode("utf8")
+
+
+def generate_csr(
+    private_key: str, common_name: str, sans: Optional[List[str]] = None
+) -> str:
+    """Generate a certificate signing request, returned as PEM.
+
+    The request is for the given common name and alternative names, and is
+    signed by the given PEM private key.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+    from cryptography.x509.oid import NameOID
+
+    key = serialization.load_pem_private_key(private_key.encode("utf8"), None)
+    names = []
+    for san in sans or []:
+        try:
+            names.append(x509.IPAddress(ipaddress.ip_address(san)))
+        except ValueError:
+            names.append(x509.DNSName(san))
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    builder = x509.CertificateSigningRequestBuilder().subject_name(subject)
+    if names:
+        builder = builder.add_extension(
+            x509.SubjectAlternativeName(names), critical=False
+        )
+    # Ed25519 keys sign without a separate digest
+    digest = None if isinstance(key, ed25519.Ed25519PrivateKey) else hashes.SHA256()
+    csr = builder.sign(key, digest)
+    return csr.public_bytes(serialization.Encoding.PEM).decode("utf8")
+
+
+def cert_matches_key(cert: str, private_key: str) -> bool:
+    """Whether a PEM cert was issued for the public half of a PEM private key."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+
+    try:
+        public_key = x509.load_pem_x509_certificate(cert.encode("utf8")).public_key()
+        key = serialization.load_pem_private_key(private_key.encode("utf8"), None)
+    except ValueError:
+        return False
+    spki = (serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return public_key.public_bytes(*spki) == key.public_key().public_bytes(*spki)
@@ -0,0 +1,76 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Helpers to write certificates from the tls-certificates relation to disk."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, List, Union
+
+if TYPE_CHECKING:
+    from .model import Certificate
+
+CERTS_INDEX = ".certs-index.json"
+
+
+def _content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+
+def write_certs(certs: Iterable[Certificate], directory: Union[str, Path]) -> List[str]:
+    """Write the cert and key of each Certificate to a directory.
+
+    The files are named `{common_name}.crt` and `{common_name}.key`.  Only
+    the files whose content changed since the previous call are written.
+    Each is written to a temporary file and synced to disk, then they are
+    all atomically renamed into place and the directory is synced once.
+    The content hashes are kept in an index file in `directory` so unchanged
+    files don't need to be read.
+
+    Returns the list of paths which were written, so that only the services
+    using those files need to be reloaded.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    index_path = directory / CERTS_INDEX
+    try:
+        index = json.loads(index_path.read_text())
+    except (OSError, ValueError):
+        index = {}
+
+    pending = []
+    for cert in certs:
+        name = cert.common_name.replace(os.sep, "_")
+        for filename, content, mode in (
+            (f"{name}.crt", cert.cert, 0o644),
+            (f"{name}.key", cert.key, 0o600),
+        ):
+            path = directory / filename
+            digest = _content_hash(content)
+            if index.get(filename) == digest and path.exists():
+                continue
+            pending.append((path, content, mode))
+            index[filename] = digest
+    if not pending:
+        return []
+
+    pending.append((index_path, json.dumps(index, sort_keys=True), 0o644))
+    for path, content, mode in pending:
+        tmp = path.with_name(f"{path.name}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+    for path, _, _ in pending:
+        os.replace(path.with_name(f"{path.name}.tmp"), path)
+    # the renames are made durable by a single sync of the directory
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return [str(path) for path, _, _ in pending[:-1]]
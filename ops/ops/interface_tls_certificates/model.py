@@ -1,4 +1,5 @@
-from typing import Optional
+from dataclasses import dataclass
+from typing import Mapping, Optional
 
 from pydantic import BaseModel, Extra, Field, StrictStr
 
@@ -20,9 +21,22 @@ class Certificate(BaseModel):
 
 
 class Data(BaseModel, extra=Extra.allow):
-    """Databag from the relation."""
+    """The shared fields, and this unit's own fields, from the relation."""
 
     ca: StrictStr = Field(alias="ca")
     chain: Optional[StrictStr] = Field(default=None, alias="chain")
     client_cert: StrictStr = Field(alias="client.cert")
     client_key: StrictStr = Field(alias="client.key")
+
+
+@dataclass(frozen=True)
+class CertificatesSnapshot:
+    """Every certificate from one revision of the relation data.
+
+    The certificates of each type are read-only mappings by common name.
+    """
+
+    server: Mapping[str, Certificate]
+    client: Mapping[str, Certificate]
+    application: Mapping[str, Certificate]
+    intermediate: Mapping[str, Certificate]
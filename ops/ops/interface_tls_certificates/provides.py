@@ -0,0 +1,632 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Implementation of the provides side of the tls-certificates interface.
+
+This is wire compatible with the reactive `TlsProvides`, so that a CA charm
+written with the operator framework can serve the same requirers.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ops.charm import CharmBase
+from ops.framework import EventBase, EventSource, Object, ObjectEvents, StoredState
+from ops.model import Relation
+
+from .cache import revision_cached
+from .crypto import canonicalize_sans
+
+log = logging.getLogger(__name__)
+
+# the requests of each cert type, as published by the requirer units
+REQUEST_FIELDS = {
+    "server": "cert_requests",
+    "client": "client_cert_requests",
+    "application": "application_cert_requests",
+    "intermediate": "intermediate_cert_requests",
+}
+
+# the certs of each cert type, prefixed by the requirer unit's name
+PUBLISH_FIELDS = {
+    "server": "processed_requests",
+    "client": "processed_client_requests",
+    "application": "processed_application_requests",
+    "intermediate": "processed_intermediate_requests",
+}
+
+# all of the fields published for each unit, which its digest covers
+UNIT_FIELDS = ("server.cert", "server.key", *PUBLISH_FIELDS.values())
+
+
+def _loads(value: Optional[str], default):
+    """Decode a JSON field from a requirer, or return the `default`."""
+    if not value:
+        return default
+    try:
+        return json.loads(value)
+    except ValueError:
+        log.warning(f"Ignoring invalid request data: {value!r}")
+        return default
+
+
+def _decoded(value: Optional[str]):
+    """Decode a field a requirer may have published either raw or as JSON.
+
+    The reactive requirer JSON-encodes every field it publishes, where the
+    operator requirer publishes plain strings.
+    """
+    if value is None:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+@dataclass(frozen=True)
+class CertificateRequest:
+    """A request for a certificate from a unit of a related application.
+
+    An application cert is shared by all units of the application, so there
+    is a single request for it with the names requested by every unit in
+    `sans`, and the names of those units in `units`.
+    """
+
+    relation: Relation
+    unit_name: str
+    cert_type: str
+    common_name: str
+    sans: Tuple[str, ...] = ()
+    cert_name: Optional[str] = None
+    csr: Optional[str] = None
+    key_type: Optional[str] = None
+    key_size: Optional[int] = None
+    requested_at: Optional[float] = None
+    units: Tuple[str, ...] = ()
+    legacy: bool = False
+
+    @property
+    def key(self) -> str:
+        """Identifies this request amongst all of the requests."""
+        return "/".join(
+            (str(self.relation.id), self.unit_name, self.cert_type, self.common_name)
+        )
+
+    @property
+    def fingerprint(self) -> str:
+        """Digest of the request data which requires a new cert if changed."""
+        data = {
+            "sans": canonicalize_sans(self.sans, self.common_name),
+            "csr": self.csr,
+            "key_type": self.key_type,
+            "key_size": self.key_size,
+        }
+        content = json.dumps(data, sort_keys=True).encode("utf8")
+        return hashlib.sha256(content).hexdigest()
+
+
+class CertificatesRequestedEvent(EventBase):
+    """Emitted when there are requests in `new_requests` to be handled."""
+
+
+class CertificatesProvidesEvents(ObjectEvents):
+    """Events emitted by the provides side of the certificates relation."""
+
+    certificates_requested = EventSource(CertificatesRequestedEvent)
+
+
+class CertificatesProvides(Object):
+    """Provides side of certificates relation.
+
+    All of the requests are read and indexed once per revision of the
+    relation data, which changes with every event of the relation.  The
+    `certificates_requested` event is emitted whenever there are requests
+    which haven't been handled yet, and the certs for them can be published
+    in one batch with `set_certs`.  Which requests have been handled is kept
+    in the charm's stored state, by a fingerprint of each request.  A digest
+    of the certs of each requirer unit is published next to them, so that
+    the requirers can skip decoding them when it is unchanged.
+
+    The certs and keys of every requirer unit are normally published in this
+    unit's relation data, which all of the requirer units can see.  With
+    `use_secrets` enabled, the certs of each requirer unit are instead kept
+    in a Juju secret which only that unit is granted, and only the ID of the
+    secret is published along with the digest.  This requires Juju 3.0 and
+    ops 2.0 or later, on both sides of the relation.
+
+    The certs of requests which have since been withdrawn are dropped when
+    the certs of a unit are published, and the number of pending requests
+    is published with an estimate of how long they will take to be handled,
+    as by the reactive provider.
+    """
+
+    on = CertificatesProvidesEvents()
+    _stored = StoredState()
+
+    def __init__(self, charm: CharmBase, endpoint="certificates", use_secrets=False):
+        super().__init__(charm, f"relation-{endpoint}")
+        self.endpoint = endpoint
+        self.use_secrets = use_secrets
+        self._revision = 0
+        self._cache = {}
+        self._handled_at = None
+
+        events = charm.on[endpoint]
+        # invalidate the caches before any other handlers of these events
+        for event in (
+            events.relation_created,
+            events.relation_joined,
+            events.relation_changed,
+            events.relation_departed,
+            events.relation_broken,
+        ):
+            self.framework.observe(event, self.refresh)
+        self.framework.observe(events.relation_joined, self._check_requests)
+        self.framework.observe(events.relation_changed, self._check_requests)
+        self.framework.observe(events.relation_departed, self._unit_departed)
+        self.framework.observe(events.relation_broken, self._relation_broken)
+
+    def refresh(self, event=None):
+        """Discard the cached relation data, so that it will be read again."""
+        self._revision += 1
+        self._cache.clear()
+
+    def _check_requests(self, event=None):
+        if self.new_requests:
+            self.on.certificates_requested.emit()
+        self._publish_queue_status()
+
+    def _publish_queue_status(self):
+        """Publish the number of pending requests, and the estimated seconds
+        until they have been handled, based on the average time per request.
+        """
+        self._stored.set_default(request_time=None)
+        pending = len(self.new_requests)
+        retry_after = None
+        if self._stored.request_time is not None:
+            retry_after = int(round(pending * self._stored.request_time))
+        status = {"pending": pending, "retry_after": retry_after}
+        self._publish_to_all("queue_status", json.dumps(status, sort_keys=True))
+
+    def _forget(self, prefix: str):
+        """Forget the fingerprints of the handled requests with a key prefix."""
+        self._stored.set_default(fingerprints={})
+        fingerprints = dict(self._stored.fingerprints)
+        kept = {
+            key: value
+            for key, value in fingerprints.items()
+            if not key.startswith(prefix)
+        }
+        if len(kept) != len(fingerprints):
+            self._stored.fingerprints = kept
+
+    def _departed_unit_names(self, relation: Relation) -> List[str]:
+        """The names of the units with published certs which have departed.
+
+        The names are those the units published, as on the publish path, so
+        that units of other models are matched as well.
+        """
+        remaining = {
+            (relation.data[unit].get("unit_name") or unit.name).replace("/", "_")
+            for unit in relation.units
+        }
+        published = {
+            key.split(".", 1)[0]
+            for key in relation.data[self.model.unit]
+            if key.endswith((".digest", ".secret"))
+        }
+        return sorted(published - remaining)
+
+    def _unit_departed(self, event):
+        relation = event.relation
+        data = relation.data[self.model.unit]
+        departed = self._departed_unit_names(relation)
+        for unit_name in departed:
+            self._forget(f"{relation.id}/{unit_name}/")
+            if self.use_secrets:
+                fields = ("secret", "digest")
+            else:
+                fields = (*UNIT_FIELDS, "digest")
+            for name in fields:
+                data.pop(f"{unit_name}.{name}", None)
+        if self.use_secrets:
+            self._remove_secrets(relation, departed)
+
+    def _relation_broken(self, event):
+        self._forget(f"{event.relation.id}/")
+        if self.use_secrets:
+            self._remove_secrets(event.relation)
+
+    def _remove_secrets(self, relation: Relation, unit_names=None):
+        """Remove the secrets of some requirer units, or of all of them."""
+        self._stored.set_default(secrets={})
+        created = list(self._stored.secrets.get(str(relation.id), []))
+        if unit_names is None:
+            unit_names = created
+        for unit_name in unit_names:
+            secret = self._unit_secret(relation, unit_name)
+            if secret:
+                secret.remove_all_revisions()
+        kept = [unit_name for unit_name in created if unit_name not in unit_names]
+        if kept != created:
+            secrets = {
+                relation_id: list(names)
+                for relation_id, names in self._stored.secrets.items()
+                if relation_id != str(relation.id)
+            }
+            if kept:
+                secrets[str(relation.id)] = kept
+            self._stored.secrets = secrets
+
+    @property
+    def relations(self) -> List[Relation]:
+        """All relations to the requirers."""
+        return self.model.relations[self.endpoint]
+
+    def _load_requests(self, relation: Relation) -> List[CertificateRequest]:
+        """Build the requests of every unit of a relation."""
+        requests, app_requests = [], []
+        for unit in relation.units:
+            data = relation.data[unit]
+            unit_name = (data.get("unit_name") or unit.name).replace("/", "_")
+            if data.get("common_name"):
+                # the first server cert request is in its own fields
+                requests.append(
+                    CertificateRequest(
+                        relation=relation,
+                        unit_name=unit_name,
+                        cert_type="server",
+                        common_name=data["common_name"],
+                        sans=tuple(canonicalize_sans(_loads(data.get("sans"), None))),
+                        cert_name=data.get("certificate_name"),
+                        csr=_decoded(data.get("csr")),
+                        key_type=_decoded(data.get("key_type")),
+                        key_size=(
+                            int(_decoded(data["key_size"]))
+                            if data.get("key_size")
+                            else None
+                        ),
+                        requested_at=_loads(data.get("requested_at"), None),
+                        legacy=True,
+                    )
+                )
+            for cert_type, field in REQUEST_FIELDS.items():
+                for cn, request in _loads(data.get(field), {}).items():
+                    if cert_type == "application":
+                        app_requests.append((unit_name, cn, request))
+                        continue
+                    requests.append(
+                        CertificateRequest(
+                            relation=relation,
+                            unit_name=unit_name,
+                            cert_type=cert_type,
+                            common_name=cn,
+                            sans=tuple(canonicalize_sans(request.get("sans"))),
+                            cert_name=cn,
+                            csr=request.get("csr"),
+                            key_type=request.get("key_type"),
+                            key_size=request.get("key_size"),
+                            requested_at=request.get("requested_at"),
+                        )
+                    )
+        if app_requests:
+            # a single cert for all of the names requested by every unit
+            sans = set()
+            for _, cn, request in app_requests:
+                sans.add(cn)
+                sans.update(request.get("sans") or [])
+            common_name = min(cn for _, cn, _ in app_requests)
+            requests.append(
+                CertificateRequest(
+                    relation=relation,
+                    unit_name=relation.app.name,
+                    cert_type="application",
+                    common_name=common_name,
+                    sans=tuple(canonicalize_sans(sans)),
+                    cert_name=common_name,
+                    key_type=app_requests[0][2].get("key_type"),
+                    key_size=app_requests[0][2].get("key_size"),
+                    requested_at=min(
+                        (
+                            r["requested_at"]
+                            for _, _, r in app_requests
+                            if "requested_at" in r
+                        ),
+                        default=None,
+                    ),
+                    units=tuple(sorted({unit for unit, _, _ in app_requests})),
+                )
+            )
+        return requests
+
+    @revision_cached
+    def _index(self) -> Dict[str, CertificateRequest]:
+        """All requests, by their key."""
+        return {
+            request.key: request
+            for relation in self.relations
+            for request in self._load_requests(relation)
+        }
+
+    @revision_cached
+    def _pending(self) -> Dict[str, Dict[str, CertificateRequest]]:
+        """The requests which haven't been handled, by cert type and key."""
+        self._stored.set_default(fingerprints={})
+        fingerprints = self._stored.fingerprints
+        pending = {cert_type: {} for cert_type in REQUEST_FIELDS}
+        self._handled_at = time.time()
+        for key, request in self._index.items():
+            if fingerprints.get(key) != request.fingerprint:
+                pending[request.cert_type][key] = request
+        return pending
+
+    @property
+    def all_requests(self) -> List[CertificateRequest]:
+        """All of the requests which have been made."""
+        return list(self._index.values())
+
+    @property
+    def new_requests(self) -> List[CertificateRequest]:
+        """The requests which haven't been handled, of every type."""
+        return [
+            request
+            for pending in self._pending.values()
+            for request in pending.values()
+        ]
+
+    @property
+    def new_server_requests(self) -> List[CertificateRequest]:
+        """The server cert requests which haven't been handled."""
+        return list(self._pending["server"].values())
+
+    @property
+    def new_client_requests(self) -> List[CertificateRequest]:
+        """The client cert requests which haven't been handled."""
+        return list(self._pending["client"].values())
+
+    @property
+    def new_application_requests(self) -> List[CertificateRequest]:
+        """The application cert requests which haven't been handled."""
+        return list(self._pending["application"].values())
+
+    @property
+    def new_intermediate_requests(self) -> List[CertificateRequest]:
+        """The intermediate CA cert requests which haven't been handled."""
+        return list(self._pending["intermediate"].values())
+
+    def set_cert(
+        self, request: CertificateRequest, cert: str, key: Optional[str] = None
+    ):
+        """Publish the cert and key for a request.
+
+        For requests with a `csr`, the key is kept by the requirer and only
+        the signed cert should be given.
+        """
+        self.set_certs([(request, cert, key)])
+
+    def set_certs(
+        self, issued: Iterable[Tuple[CertificateRequest, str, Optional[str]]]
+    ) -> int:
+        """Publish the certs and keys for many requests at once.
+
+        Each field of the relation data is only decoded and encoded once,
+        however many of the certs go in it, and the digest of each unit's
+        certs is then updated.  Returns the number of cert fields which were
+        written.
+        """
+        self._stored.set_default(fingerprints={}, request_time=None)
+        fingerprints = dict(self._stored.fingerprints)
+        relations, updates, raw = {}, {}, {}
+        handled = 0
+        for request, cert, key in issued:
+            relation = request.relation
+            relations[relation.id] = relation
+            entry = {"cert": cert}
+            if key:
+                entry["key"] = key
+            if request.cert_type == "application":
+                # the same cert is sent to every unit of the application
+                for unit_name in request.units:
+                    field = f"{unit_name}.{PUBLISH_FIELDS['application']}"
+                    updates.setdefault((relation.id, field), {})["app_data"] = entry
+            elif request.legacy:
+                # for backwards compatibility, the first server cert goes in
+                # its own fields
+                raw[(relation.id, f"{request.unit_name}.server.cert")] = cert
+                raw[(relation.id, f"{request.unit_name}.server.key")] = key
+            else:
+                field = f"{request.unit_name}.{PUBLISH_FIELDS[request.cert_type]}"
+                updates.setdefault((relation.id, field), {})[
+                    request.common_name
+                ] = entry
+            fingerprints[request.key] = request.fingerprint
+            if self._pending[request.cert_type].pop(request.key, None):
+                handled += 1
+
+        published = {
+            (relation_id, field.split(".", 1)[0]): None
+            for relation_id, field in [*updates, *raw]
+        }
+        for relation_id, unit_name in published:
+            published[(relation_id, unit_name)] = self._requested_fields(
+                relations[relation_id], unit_name
+            )
+        for (relation_id, field), certs in updates.items():
+            unit_name, name = field.split(".", 1)
+            fields = published[(relation_id, unit_name)]
+            merged = _loads(fields.get(name), {})
+            merged.update(certs)
+            fields[name] = json.dumps(merged, sort_keys=True)
+        for (relation_id, field), value in raw.items():
+            unit_name, name = field.split(".", 1)
+            published[(relation_id, unit_name)][name] = value
+        for (relation_id, unit_name), fields in published.items():
+            self._publish_unit(relations[relation_id], unit_name, fields)
+        self._stored.fingerprints = fingerprints
+        if handled and self._handled_at is not None:
+            # moving average of the time taken to handle each request
+            now = time.time()
+            elapsed = (now - self._handled_at) / handled
+            average = self._stored.request_time
+            if average is not None:
+                elapsed = 0.8 * average + 0.2 * elapsed
+            self._stored.request_time = elapsed
+            self._handled_at = now
+        self._publish_queue_status()
+        return len(updates) + len(raw)
+
+    def _requested_fields(self, relation: Relation, unit_name: str) -> dict:
+        """The published fields of a requirer unit, without the certs of the
+        requests which have since been withdrawn.
+        """
+        fields = self._unit_fields(relation, unit_name)
+        prefix = f"{relation.id}/{unit_name}/"
+        requested = {
+            key.split("/", 2)[2] for key in self._index if key.startswith(prefix)
+        }
+        app_requested = any(
+            unit_name in request.units
+            for request in self._index.values()
+            if request.relation.id == relation.id and request.cert_type == "application"
+        )
+        for cert_type, name in PUBLISH_FIELDS.items():
+            certs = _loads(fields.get(name), {})
+            if cert_type == "application":
+                kept = certs if app_requested else {}
+            else:
+                kept = {
+                    cn: entry
+                    for cn, entry in certs.items()
+                    if f"{cert_type}/{cn}" in requested
+                }
+            if len(kept) != len(certs):
+                fields[name] = json.dumps(kept, sort_keys=True) if kept else None
+        legacy = any(
+            request.legacy
+            for key, request in self._index.items()
+            if key.startswith(prefix)
+        )
+        if not legacy:
+            fields["server.cert"] = fields["server.key"] = None
+        return fields
+
+    def _secret_label(self, relation: Relation, unit_name: str) -> str:
+        return f"{self.endpoint}-{relation.id}-{unit_name}"
+
+    def _unit_secret(self, relation: Relation, unit_name: str):
+        """The secret with the certs of a requirer unit, or None."""
+        from ops.model import SecretNotFoundError
+
+        try:
+            return self.model.get_secret(label=self._secret_label(relation, unit_name))
+        except SecretNotFoundError:
+            return None
+
+    def _unit_fields(self, relation: Relation, unit_name: str) -> dict:
+        """The fields published with the certs of a requirer unit."""
+        if self.use_secrets:
+            secret = self._unit_secret(relation, unit_name)
+            return json.loads(secret.peek_content()["certs"]) if secret else {}
+        data = relation.data[self.model.unit]
+        return {field: data.get(f"{unit_name}.{field}") for field in UNIT_FIELDS}
+
+    def _publish_unit(self, relation: Relation, unit_name: str, fields: dict):
+        """Publish the fields with the certs of a requirer unit.
+
+        A digest of them is published as well, so that the requirer can tell
+        that its certs are unchanged without decoding them.
+        """
+        fields = {name: value for name, value in fields.items() if value}
+        data = relation.data[self.model.unit]
+        digest = None
+        if fields:
+            content = "\n".join(fields.get(name) or "" for name in UNIT_FIELDS)
+            digest = hashlib.sha256(content.encode("utf8")).hexdigest()[:16]
+        if data.get(f"{unit_name}.digest") == digest:
+            return
+        if self.use_secrets:
+            self._publish_secret(relation, unit_name, fields)
+        else:
+            for name in UNIT_FIELDS:
+                if fields.get(name):
+                    data[f"{unit_name}.{name}"] = fields[name]
+                else:
+                    data.pop(f"{unit_name}.{name}", None)
+        if digest:
+            data[f"{unit_name}.digest"] = digest
+        else:
+            data.pop(f"{unit_name}.digest", None)
+
+    def _publish_secret(self, relation: Relation, unit_name: str, fields: dict):
+        """Keep the fields with the certs of a requirer unit in a secret.
+
+        The secret is only granted to that unit, and its ID is published.
+        """
+        content = {"certs": json.dumps(fields, sort_keys=True)}
+        secret = self._unit_secret(relation, unit_name)
+        if secret:
+            secret.set_content(content)
+            return
+        secret = self.model.unit.add_secret(
+            content,
+            label=self._secret_label(relation, unit_name),
+            description=f"Certificates of {unit_name}",
+        )
+        for unit in relation.units:
+            name = relation.data[unit].get("unit_name") or unit.name
+            if name.replace("/", "_") == unit_name:
+                secret.grant(relation, unit=unit)
+        relation.data[self.model.unit][f"{unit_name}.secret"] = secret.id
+        # remembered so that they can be removed with the relation
+        self._stored.set_default(secrets={})
+        secrets = {
+            relation_id: list(names)
+            for relation_id, names in self._stored.secrets.items()
+        }
+        secrets.setdefault(str(relation.id), []).append(unit_name)
+        self._stored.secrets = secrets
+
+    def _publish_to_all(self, field: str, value: Optional[str]) -> int:
+        """Publish a value to every relation which doesn't have it already.
+
+        Returns the number of relations which were updated.
+        """
+        updated = 0
+        for relation in self.relations:
+            data = relation.data[self.model.unit]
+            if data.get(field) != value:
+                if value:
+                    data[field] = value
+                else:
+                    data.pop(field, None)
+                updated += 1
+        return updated
+
+    def set_ca(self, certificate_authority: str) -> int:
+        """Publish the CA to all related applications.
+
+        Returns the number of relations which were updated.
+        """
+        return self._publish_to_all("ca", certificate_authority)
+
+    def set_chain(self, chain: str) -> int:
+        """Publish the chain of trust to all related applications.
+
+        Returns the number of relations which were updated.
+        """
+        return self._publish_to_all("chain", chain)
+
+    def set_client_cert(self, cert: str, key: str) -> int:
+        """Publish a globally shared client cert and key.
+
+        This is only for backwards compatibility with requirers which
+        expect it.  Returns the number of relations which were updated.
+        """
+        updated = self._publish_to_all("client.cert", cert)
+        return max(updated, self._publish_to_all("client.key", key))
@@ -1,63 +1,547 @@
 # Copyright 2023 Canonical Ltd.
 # See LICENSE file for licensing details.
-"""Implementation of tls-certificates interface.
+"""Implementation of the requires side of the tls-certificates interface.
 
-This only implements the requires side, currently, since the providers
-is still using the Reactive Charm framework self.
+The pydantic models are only imported once the relation data is first read,
+so that hooks which don't use the certificates don't pay for them.
 """
+
+from __future__ import annotations
+
+import hashlib
 import json
 import logging
-import uuid
-from backports.cached_property import cached_property
-from typing import List, Mapping, Optional
+import time
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional
 
 from ops.charm import CharmBase, RelationBrokenEvent
-from ops.framework import Object
-from pydantic import ValidationError
+from ops.framework import EventBase, EventSource, Object, ObjectEvents, StoredState
+from ops.model import Relation
 
-from .model import Data, Certificate
+from .cache import revision_cached
+from .crypto import cert_matches_key, generate_csr, generate_private_key, key_options
+
+if TYPE_CHECKING:
+    from .model import CertificatesSnapshot, Data, Certificate
 
 log = logging.getLogger(__name__)
 
+# fields which stamp when a request was made, and so aren't part of its content
+STAMP_FIELDS = ("requested_at", "request_seq")
+
+# upper bounds, in seconds, of the buckets of issuance latency histograms
+LATENCY_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 3600)
+
+# fields published by the CA for all units, which are validated by `Data`
+SHARED_FIELDS = ("ca", "chain", "client.cert", "client.key")
+
+# fields published by the CA for each unit, prefixed by the unit's name
+UNIT_FIELDS = (
+    "server.cert",
+    "server.key",
+    "processed_requests",
+    "processed_client_requests",
+    "processed_application_requests",
+    "processed_intermediate_requests",
+    "digest",
+    "secret",
+)
+
+REQUEST_FIELDS = {
+    "server": "cert_requests",
+    "client": "client_cert_requests",
+    "application": "application_cert_requests",
+    "intermediate": "intermediate_cert_requests",
+}
+
+
+class CertificatesEvent(EventBase):
+    """Base of the events for the certs of one type with some common names.
+
+    The `cert_type` is one of 'server', 'client', 'application' or
+    'intermediate', and `common_names` are those of the affected certs.
+    """
+
+    def __init__(self, handle, cert_type: str, common_names: List[str]):
+        super().__init__(handle)
+        self.cert_type = cert_type
+        self.common_names = common_names
+
+    def snapshot(self) -> dict:
+        return {"cert_type": self.cert_type, "common_names": self.common_names}
+
+    def restore(self, snapshot: dict):
+        self.cert_type = snapshot["cert_type"]
+        self.common_names = snapshot["common_names"]
 
-class CertificatesRequires(Object):
-    """Requires side of certificates relation."""
 
-    def __init__(self, charm: CharmBase, endpoint="certificates"):
+class CertificateAvailableEvent(CertificatesEvent):
+    """Emitted when certs have been received for the first time."""
+
+
+class CertificateChangedEvent(CertificatesEvent):
+    """Emitted when certs which were received before have changed."""
+
+
+class CertificateRemovedEvent(CertificatesEvent):
+    """Emitted when certs which were received before are no longer available."""
+
+
+class CAChangedEvent(EventBase):
+    """Emitted when the CA, or the chain of trust, has changed."""
+
+
+class CertificatesRequiresEvents(ObjectEvents):
+    """Events emitted by the requires side of the certificates relation."""
+
+    certificate_available = EventSource(CertificateAvailableEvent)
+    certificate_changed = EventSource(CertificateChangedEvent)
+    certificate_removed = EventSource(CertificateRemovedEvent)
+    ca_changed = EventSource(CAChangedEvent)
+
+
+class CertificatesRequires(Object):
+    """Requires side of certificates relation.
+
+    By default, only a single CA may be related.  With `fan_out` enabled,
+    requests are spread across all related CAs by hashing their common name,
+    and the certs and CA certificates received from each of them are
+    aggregated into a single view.
+
+    With `csr_mode` enabled, server and client cert requests carry a
+    certificate signing request for a private key which is generated and kept
+    locally, and only the signed cert is sent back by the CA.  This requires
+    the `csr` extra of this package.
+
+    Each request is stamped with the time it was made and a sequence number,
+    which are kept until the request changes.  The time from each request
+    until its cert first appears is recorded in the `issuance_latency`
+    histograms.
+
+    The relation data is decoded and validated once per revision, which
+    changes with every event of the relation, so that the same instance can
+    be used for the lifetime of the charm.  Use `refresh()` to force it to
+    be read again.  The certificates are kept in an immutable snapshot per
+    revision, which the cert lists and maps are views of.
+
+    If a CA delivers the certs of this unit in a Juju secret, rather than in
+    its relation data, they are read from the secret whenever their digest
+    changes, and cached in the charm's stored state in between.
+
+    When the certs change, the `certificate_available`, `certificate_changed`
+    and `certificate_removed` events are emitted with the common names of only
+    the affected certs of each type, and `ca_changed` when the CA changes.
+    These are found by comparing fingerprints of the certs with those seen
+    in the previous hook, which are kept in the charm's stored state.  When
+    the CAs publish a digest of this unit's certs and it is unchanged, the
+    certs aren't decoded at all.
+    """
+
+    on = CertificatesRequiresEvents()
+    _stored = StoredState()
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        endpoint="certificates",
+        fan_out=False,
+        csr_mode=False,
+    ):
         super().__init__(charm, f"relation-{endpoint}")
         self.endpoint = endpoint
+        self.fan_out = fan_out
+        self.csr_mode = csr_mode
         self._unit_name = self.model.unit.name.replace("/", "_")
+        self._revision = 0
+        self._cache = {}
 
         events = charm.on[endpoint]
+        # invalidate the caches before any other handlers of these events
+        for event in (
+            events.relation_created,
+            events.relation_joined,
+            events.relation_changed,
+            events.relation_departed,
+            events.relation_broken,
+        ):
+            self.framework.observe(event, self.refresh)
         self.framework.observe(events.relation_joined, self._joined)
+        self.framework.observe(events.relation_changed, self._record_latency)
+        for event in (
+            events.relation_changed,
+            events.relation_departed,
+            events.relation_broken,
+        ):
+            self.framework.observe(event, self._emit_changes)
+
+    def refresh(self, event=None):
+        """Discard the cached relation data, so that it will be read again.
+
+        This is done for every relation event, and whenever this unit's own
+        relation data is written.
+        """
+        self._revision += 1
+        self._cache.clear()
 
     def _joined(self, event=None):
         event.relation.data[self.model.unit]["unit_name"] = self._unit_name
+        self.refresh()
 
-    @cached_property
+    def _record_latency(self, event=None):
+        """Record the latency of each request whose cert has appeared since."""
+        if self._certs_unchanged:
+            return
+        # stored as JSON, since the histograms are nested
+        self._stored.set_default(issued="{}", latency="{}")
+        issued = json.loads(self._stored.issued)
+        latency = json.loads(self._stored.latency)
+        fingerprints = self._fingerprints["certs"]
+        now = time.time()
+        for cert_type, cn, stamp in self._stamped_requests():
+            # the application cert is shared by all of its common names
+            key = "app_data" if cert_type == "application" else cn
+            fingerprint = fingerprints[cert_type].get(key)
+            if fingerprint is None:
+                continue
+            seen = issued.get(f"{cert_type}.{cn}", {})
+            seq = int(stamp["request_seq"])
+            if seen.get("seq") == seq or seen.get("fingerprint") == fingerprint:
+                continue
+            issued[f"{cert_type}.{cn}"] = {"seq": seq, "fingerprint": fingerprint}
+            histogram = latency.setdefault(cert_type, {"buckets": {}})
+            seconds = max(0.0, now - float(stamp["requested_at"]))
+            bucket = next((str(b) for b in LATENCY_BUCKETS if seconds <= b), "+Inf")
+            histogram["buckets"][bucket] = histogram["buckets"].get(bucket, 0) + 1
+            histogram["count"] = histogram.get("count", 0) + 1
+            histogram["sum"] = histogram.get("sum", 0.0) + seconds
+        self._stored.issued = json.dumps(issued)
+        self._stored.latency = json.dumps(latency)
+
+    @revision_cached
+    def _certs_digest(self) -> Optional[str]:
+        """The digests of this unit's certs published by the CAs.
+
+        This includes the chain, since it is appended to the certs, and is
+        None unless every CA publishes a digest.
+        """
+        _, _, _, digests = self._provider_data
+        if not digests or None in digests:
+            return None
+        chain = (self._raw_data or {}).get("chain") or ""
+        return ",".join([*digests, hashlib.sha256(chain.encode()).hexdigest()[:16]])
+
+    @revision_cached
+    def _seen(self) -> dict:
+        """The fingerprints as of the previous hook."""
+        self._stored.set_default(fingerprints="{}")
+        return json.loads(self._stored.fingerprints)
+
+    @revision_cached
+    def _certs_unchanged(self) -> bool:
+        """Whether the CAs say that none of this unit's certs have changed."""
+        digest = self._certs_digest
+        return digest is not None and self._seen.get("digest") == digest
+
+    @revision_cached
+    def _fingerprints(self) -> dict:
+        """Fingerprints of the CA and chain, and of each cert by type and CN."""
+
+        def digest(*values):
+            content = "\n".join(value or "" for value in values)
+            return hashlib.sha256(content.encode()).hexdigest()
+
+        fingerprints = {
+            "ca": digest(self.ca, self.chain) if self.is_ready else None,
+            "digest": self._certs_digest,
+        }
+        if self._certs_unchanged:
+            # no need to decode the certs to find that they are the same
+            fingerprints["certs"] = self._seen["certs"]
+            return fingerprints
+        snapshot = self._snapshot
+        certs_maps = {
+            "server": snapshot.server,
+            "client": snapshot.client,
+            "application": snapshot.application,
+            "intermediate": snapshot.intermediate,
+        }
+        fingerprints["certs"] = {
+            cert_type: {cn: digest(cert.cert, cert.key) for cn, cert in certs.items()}
+            for cert_type, certs in certs_maps.items()
+        }
+        return fingerprints
+
+    def _emit_changes(self, event=None):
+        """Emit the events for the certs which changed since the last hook."""
+        seen = self._seen
+        current = self._fingerprints
+        self._stored.fingerprints = json.dumps(current)
+
+        if current["ca"] and current["ca"] != seen.get("ca"):
+            self.on.ca_changed.emit()
+        seen_certs: Dict[str, dict] = seen.get("certs", {})
+        for cert_type, certs in current["certs"].items():
+            previous = seen_certs.get(cert_type, {})
+            available = sorted(cn for cn in certs if cn not in previous)
+            changed = sorted(
+                cn for cn in certs if cn in previous and previous[cn] != certs[cn]
+            )
+            removed = sorted(cn for cn in previous if cn not in certs)
+            if available:
+                self.on.certificate_available.emit(cert_type, available)
+            if changed:
+                self.on.certificate_changed.emit(cert_type, changed)
+            if removed:
+                self.on.certificate_removed.emit(cert_type, removed)
+
+    @property
+    def issuance_latency(self) -> Mapping[str, dict]:
+        """Histograms of the time from each request until its cert appeared.
+
+        These are keyed by cert type, and each has the `count` and `sum` of the
+        latencies in seconds, and the count of latencies in each bucket of
+        `buckets`, keyed by the bucket's upper bound in seconds or '+Inf'.
+        """
+        self._stored.set_default(latency="{}")
+        return json.loads(self._stored.latency)
+
+    def _stamped_requests(self):
+        """Yield the cert type, common name and stamp of each request made."""
+        for relation in self.relations:
+            data = relation.data[self.model.unit]
+            if data.get("request_seq"):
+                # the first server cert request is in its own fields
+                yield "server", data["common_name"], data
+            for cert_type, field in REQUEST_FIELDS.items():
+                for cn, request in json.loads(data.get(field, "{}")).items():
+                    if request.get("request_seq"):
+                        yield cert_type, cn, request
+
+    def _stamp(self, request: dict, previous: Optional[dict]) -> dict:
+        """Stamp a request with the time it was made and a sequence number.
+
+        The stamp of the `previous` request is kept if it is otherwise unchanged.
+        """
+        # compared as it will be published, since the previous request was decoded
+        request = json.loads(json.dumps(request))
+        previous = dict(previous or {})
+        stamp = {field: previous.pop(field, None) for field in STAMP_FIELDS}
+        if previous == request and None not in stamp.values():
+            return dict(request, **stamp)
+        return dict(
+            request, requested_at=time.time(), request_seq=self._next_request_seq()
+        )
+
+    def _next_request_seq(self) -> int:
+        """Allocate a sequence number, which is never reused for this unit."""
+        self._stored.set_default(request_seq=0)
+        self._stored.request_seq += 1
+        return self._stored.request_seq
+
+    @revision_cached
     def relation(self):
         """The relation to the integrator, or None."""
         return self.model.get_relation(self.endpoint)
 
-    @cached_property
+    @revision_cached
+    def relations(self) -> List[Relation]:
+        """All relations to the integrators."""
+        if self.fan_out:
+            return self.model.relations[self.endpoint]
+        return [self.relation] if self.relation else []
+
+    def _csr_for(
+        self, cert_type: str, cn: str, sans: Optional[List[str]], options=None
+    ) -> str:
+        """Return the CSR for a request.
+
+        The private key is generated the first time the cert is requested, or
+        when its key `options` change, and a new CSR whenever the `sans` change.
+        The previous key is kept until a cert for the new one arrives.
+        """
+        self._stored.set_default(csr={})
+        sans = sorted(set(sans or []))
+        options = dict(options or {})
+        stored = dict(self._stored.csr.get(f"{cert_type}.{cn}", {}))
+        if not stored.get("key") or dict(stored.get("key_options", {})) != options:
+            previous_key = stored.get("previous_key") or stored.get("key")
+            stored = {
+                "key": generate_private_key(**options),
+                "key_options": options,
+            }
+            if previous_key:
+                stored["previous_key"] = previous_key
+        if not stored.get("csr") or list(stored.get("sans", [])) != sans:
+            stored["csr"] = generate_csr(stored["key"], cn, sans)
+            stored["sans"] = sans
+            self._stored.csr[f"{cert_type}.{cn}"] = stored
+        return stored["csr"]
+
+    def _cert_key(
+        self, cert_type: str, cn: str, cert: Optional[str], key: Optional[str]
+    ) -> Optional[str]:
+        """The private key for a cert, using the local key if the CA sent none.
+
+        While the key is being replaced, only the key which the cert was
+        issued for is returned, and the previous key is dropped once the cert
+        for the new key has arrived.
+        """
+        if key or not self.csr_mode:
+            return key
+        self._stored.set_default(csr={})
+        stored = dict(self._stored.csr.get(f"{cert_type}.{cn}", {}))
+        key, previous_key = stored.get("key"), stored.get("previous_key")
+        if not previous_key or not cert:
+            return key
+        if key and cert_matches_key(cert, key):
+            del stored["previous_key"]
+            self._stored.csr[f"{cert_type}.{cn}"] = stored
+            return key
+        return previous_key if cert_matches_key(cert, previous_key) else None
+
+    def _relation_for(self, cn: str) -> Optional[Relation]:
+        """Select the relation which a request for `cn` should be sent to.
+
+        With fan-out enabled, this uses rendezvous hashing of the remote
+        application and common name, so that only the requests of a single
+        CA are moved when another CA is related or removed.
+        """
+        if not self.fan_out:
+            # assume we'll only be connected to one provider
+            return self.relation
+
+        def weight(relation):
+            key = f"{relation.app.name}:{cn}".encode("utf8")
+            return hashlib.sha256(key).digest()
+
+        return max(self.relations, key=weight, default=None)
+
+    def _drop_request(self, cn: str, field: str, keep: Optional[Relation] = None):
+        """Remove the request for `cn` from `field` on every relation but `keep`."""
+        for relation in self.relations:
+            if relation is keep:
+                continue
+            data = relation.data[self.model.unit]
+            if field == "cert_requests" and data.get("common_name") == cn:
+                # the first server cert request is in its own fields
+                for key in (
+                    "common_name",
+                    "sans",
+                    "certificate_name",
+                    "csr",
+                    "key_type",
+                    "key_size",
+                    *STAMP_FIELDS,
+                ):
+                    data.pop(key, None)
+            requests = json.loads(data.get(field, "{}"))
+            if cn in requests:
+                del requests[cn]
+                if requests:
+                    data[field] = json.dumps(requests)
+                else:
+                    data.pop(field)
+
+    @revision_cached
+    def _provider_data(self):
+        """The data received from all related CAs, read in a single pass.
+
+        Only the shared fields and this unit's own fields are kept, since the
+        certs of every other unit are of no interest and would otherwise all
+        be validated.
+        """
+        data, cas, server, digests, secret_ids = {}, [], [], [], set()
+        fields = SHARED_FIELDS + tuple(
+            f"{self._unit_name}.{field}" for field in UNIT_FIELDS
+        )
+        cert_field = f"{self._unit_name}.server.cert"
+        key_field = f"{self._unit_name}.server.key"
+        for relation in self.relations:
+            relation_data = {}
+            for unit in relation.units:
+                databag = relation.data[unit]
+                for key in fields:
+                    value = databag.get(key)
+                    if value is not None:
+                        relation_data[key] = value
+            secret_id = relation_data.get(f"{self._unit_name}.secret")
+            if secret_id:
+                # this unit's certs are delivered privately, in a secret
+                secret_ids.add(secret_id)
+                content = self._secret_content(
+                    secret_id, relation_data.get(f"{self._unit_name}.digest")
+                )
+                for field, value in content.items():
+                    relation_data[f"{self._unit_name}.{field}"] = value
+            if relation_data.get(cert_field):
+                server.append(
+                    (relation, relation_data[cert_field], relation_data.get(key_field))
+                )
+            digests.append(relation_data.get(f"{self._unit_name}.digest"))
+            for key, value in relation_data.items():
+                if key == "ca" and value not in cas:
+                    cas.append(value)
+                if ".processed_" in key and key in data:
+                    # the same unit's certs from several CAs
+                    merged = {**json.loads(data[key]), **json.loads(value)}
+                    value = json.dumps(merged)
+                data[key] = value
+        self._prune_secret_cache(secret_ids)
+        return data, cas, server, digests
+
+    def _secret_content(self, secret_id: str, digest: Optional[str]) -> dict:
+        """The fields in a secret from a CA, which are cached by its digest."""
+        from ops.model import ModelError
+
+        self._stored.set_default(secrets="{}")
+        cache = json.loads(self._stored.secrets)
+        cached = cache.get(secret_id)
+        if cached and digest and cached["digest"] == digest:
+            return cached["fields"]
+        try:
+            secret = self.model.get_secret(id=secret_id)
+            fields = json.loads(secret.get_content(refresh=True)["certs"])
+        except ModelError as e:
+            log.warning(f"Unable to read the certs in secret {secret_id}: {e}")
+            return {}
+        cache[secret_id] = {"digest": digest, "fields": fields}
+        self._stored.secrets = json.dumps(cache)
+        return fields
+
+    def _prune_secret_cache(self, secret_ids):
+        """Drop the cached fields of the secrets which are no longer published."""
+        self._stored.set_default(secrets="{}")
+        cache = json.loads(self._stored.secrets)
+        kept = {
+            secret_id: cached
+            for secret_id, cached in cache.items()
+            if secret_id in secret_ids
+        }
+        if len(kept) != len(cache):
+            self._stored.secrets = json.dumps(kept)
+
+    @revision_cached
     def _raw_data(self):
-        if self.relation and self.relation.units:
-            data = {}
-            for unit in self.relation.units:
-                data.update(self.relation.data[unit])
-            return data
-        return None
+        data, _, _, _ = self._provider_data
+        return data or None
 
-    @cached_property
+    @revision_cached
     def _data(self) -> Optional[Data]:
+        from .model import Data
+
         raw = self._raw_data
         return Data(**raw) if raw else None
 
     def evaluate_relation(self, event) -> Optional[str]:
         """Determine if relation is ready."""
-        no_relation = not self.relation or (
-            isinstance(event, RelationBrokenEvent) and event.relation is self.relation
-        )
+        no_relation = not [
+            relation
+            for relation in self.relations
+            if not (
+                isinstance(event, RelationBrokenEvent) and event.relation is relation
+            )
+        ]
         if not self.is_ready:
             if no_relation:
                 return f"Missing required {self.endpoint}"
@@ -67,6 +551,12 @@ class CertificatesRequires(Object):
     @property
     def is_ready(self):
         """Whether the request for this instance has been completed."""
+        return self._ready
+
+    @revision_cached
+    def _ready(self):
+        from pydantic import ValidationError
+
         try:
             self._data
         except ValidationError as ve:
@@ -77,6 +567,70 @@ class CertificatesRequires(Object):
             return False
         return True
 
+    def _certs(
+        self, cert_type: str, certs_data: dict, chain: Optional[str] = None
+    ) -> Mapping[str, Certificate]:
+        """Build the certs of a type from their data, keyed by common name."""
+        from .model import Certificate
+
+        certs = {}
+        for common_name, cert_data in certs_data.items():
+            key = self._cert_key(
+                cert_type, common_name, cert_data.get("cert"), cert_data.get("key")
+            )
+            if not key:
+                # without a key, the cert is of no use
+                continue
+            certs[common_name] = Certificate(
+                cert_type=cert_type,
+                common_name=common_name,
+                cert=cert_data.get("cert"),
+                key=key,
+                chain=chain,
+            )
+        return MappingProxyType(certs)
+
+    @revision_cached
+    def _snapshot(self) -> CertificatesSnapshot:
+        """All of the certs received in this revision of the relation data."""
+        from .model import CertificatesSnapshot
+
+        if not self.is_ready:
+            empty = MappingProxyType({})
+            return CertificatesSnapshot(
+                server=empty, client=empty, application=empty, intermediate=empty
+            )
+
+        def processed(field):
+            return json.loads(getattr(self._data, f"{self._unit_name}.{field}", "{}"))
+
+        common_names = {
+            relation: relation.data.get(self.model.unit, {}).get("common_name")
+            for relation in self.relations
+        }
+        server = {}
+        if any(common_names.values()):
+            # for backwards compatibility, the first cert goes in its own fields
+            _, _, legacy, _ = self._provider_data
+            for relation, cert, key in legacy:
+                if common_names.get(relation):
+                    server[common_names[relation]] = {"cert": cert, "key": key}
+            server.update(processed("processed_requests"))
+        else:
+            log.warning(f"Relation {self.endpoint} has yet to set 'common_name'.")
+        return CertificatesSnapshot(
+            server=self._certs("server", server, self.chain),
+            client=self._certs(
+                "client", processed("processed_client_requests"), self.chain
+            ),
+            application=self._certs(
+                "server", processed("processed_application_requests"), self.chain
+            ),
+            intermediate=self._certs(
+                "intermediate", processed("processed_intermediate_requests")
+            ),
+        )
+
     @property
     def ca(self):
         """The ca value."""
@@ -85,6 +639,43 @@ class CertificatesRequires(Object):
 
         return self._data.ca
 
+    @property
+    def ca_bundle(self) -> Optional[str]:
+        """All of the distinct CA certificates from every related CA.
+
+        This is the same as `ca` unless fan-out is enabled.
+        """
+        if not self.is_ready:
+            return None
+
+        _, cas, _, _ = self._provider_data
+        return "\n".join(cas)
+
+    @property
+    def queue_status(self) -> Optional[dict]:
+        """How busy the related CAs are, or None if they don't say.
+
+        This is a dict with the number of requests `pending` across all of the
+        related CAs, and an estimate of the seconds until they are handled as
+        `retry_after`, or None if there is no estimate yet.
+        """
+        statuses = []
+        for relation in self.relations:
+            status = None
+            for unit in relation.units:
+                status = relation.data[unit].get("queue_status") or status
+            if status:
+                statuses.append(json.loads(status))
+        if not statuses:
+            return None
+        estimates = [
+            s["retry_after"] for s in statuses if s.get("retry_after") is not None
+        ]
+        return {
+            "pending": sum(s.get("pending", 0) for s in statuses),
+            "retry_after": max(estimates) if estimates else None,
+        }
+
     @property
     def chain(self):
         """Intermediate certificates used to connect client/server certificates
@@ -97,29 +688,14 @@ class CertificatesRequires(Object):
     @property
     def client_certs(self) -> List[Certificate]:
         """Certificate instances for all available client certs."""
-        if not self.is_ready:
-            return []
-
-        field = f"{self._unit_name}.processed_client_requests"
-        certs_json = getattr(self._data, field, "{}")
-        certs_data = json.loads(certs_json)
-        return [
-            Certificate(
-                cert_type="client",
-                common_name=common_name,
-                cert=cert_data.get("cert"),
-                key=cert_data.get("key"),
-                chain=self.chain,
-            )
-            for common_name, cert_data in certs_data.items()
-        ]
+        return list(self._snapshot.client.values())
 
     @property
     def client_certs_map(self) -> Mapping[str, Certificate]:
         """Certificate instances by their `common_name`."""
-        return {cert.common_name: cert for cert in self.client_certs}
+        return self._snapshot.client
 
-    def request_client_cert(self, cn, sans=None):
+    def request_client_cert(self, cn, sans=None, key_type=None, key_size=None):
         """Request Client certificate for charm.
 
         Request a client certificate and key be generated for the given
@@ -127,16 +703,28 @@ class CertificatesRequires(Object):
         This can be called multiple times to request more than one client
         certificate, although the common names must be unique.  If called
         again with the same common name, it will be ignored.
+
+        The optional `key_type` ('rsa', 'ecdsa' or 'ed25519') and `key_size`
+        select the algorithm of the private key; by default, the CA decides.
         """
-        if not self.relation:
+        options = key_options(key_type, key_size)
+        relation = self._relation_for(cn)
+        if not relation:
             return
-        # assume we'll only be connected to one provider
-        data = self.relation.data[self.model.unit]
+        if self.fan_out:
+            self._drop_request(cn, "client_cert_requests", keep=relation)
+        data = relation.data[self.model.unit]
         requests = json.loads(data.get("client_cert_requests", "{}"))
-        requests[cn] = {"sans": sans}
+        request = dict(options, sans=sans)
+        if self.csr_mode:
+            request["csr"] = self._csr_for("client", cn, sans, options)
+        requests[cn] = self._stamp(request, requests.get(cn))
         data["client_cert_requests"] = json.dumps(requests)
+        self.refresh()
 
-    def request_server_cert(self, cn, sans=None, cert_name=None):
+    def request_server_cert(
+        self, cn, sans=None, cert_name=None, key_type=None, key_size=None
+    ):
         """
         Request a server certificate and key be generated for the given
         common name (`cn`) and optional list of alternative names (`sans`).
@@ -144,91 +732,123 @@ class CertificatesRequires(Object):
         This can be called multiple times to request more than one server
         certificate, although the common names must be unique.  If called
         again with the same common name, it will be ignored.
+
+        The optional `key_type` ('rsa', 'ecdsa' or 'ed25519') and `key_size`
+        select the algorithm of the private key; by default, the CA decides.
         """
-        if not self.relation:
+        options = key_options(key_type, key_size)
+        relation = self._relation_for(cn)
+        if not relation:
             return
-        # assume we'll only be connected to one provider
-        data = self.relation.data[self.model.unit]
+        if self.fan_out:
+            self._drop_request(cn, "cert_requests", keep=relation)
+        data = relation.data[self.model.unit]
+        csr = self._csr_for("server", cn, sans, options) if self.csr_mode else None
         if data.get("common_name") in (None, "", cn):
             # for backwards compatibility, first request goes in its own fields
+            fields = {"sans": json.dumps(sans or []), "csr": csr}
+            fields.update({key: str(value) for key, value in options.items()})
+            fields = {key: value for key, value in fields.items() if value}
+            previous = None
+            if data.get("common_name") == cn:
+                previous = {
+                    key: data[key]
+                    for key in ("sans", "csr", "key_type", "key_size", *STAMP_FIELDS)
+                    if data.get(key)
+                }
+            fields = self._stamp(fields, previous)
             data["common_name"] = cn
-            data["sans"] = json.dumps(sans or [])
             cert_name = data.get("certificate_name") or cert_name
             if cert_name is None:
+                import uuid
+
                 cert_name = str(uuid.uuid4())
             data["certificate_name"] = cert_name
+            for key in ("sans", "csr", "key_type", "key_size", *STAMP_FIELDS):
+                if key in fields:
+                    data[key] = str(fields[key])
+                else:
+                    data.pop(key, None)
         else:
             # subsequent requests go in the collection
-            requests = data.get("cert_requests", {})
-            requests[cn] = {"sans": sans or []}
+            requests = json.loads(data.get("cert_requests", "{}"))
+            request = dict(options, sans=sans or [])
+            if csr:
+                request["csr"] = csr
+            requests[cn] = self._stamp(request, requests.get(cn))
             data["cert_requests"] = json.dumps(requests)
+        self.refresh()
 
     @property
     def server_certs(self) -> List[Certificate]:
         """
         List of [Certificate][] instances for all available server certs.
         """
-        if not self.relation:
-            log.warning(f"Relation {self.endpoint} is not yet available.")
-            return []
-        common_name = self.relation.data[self.model.unit].get("common_name")
-        if common_name is None or not self.is_ready:
-            log.warning(f"Relation {self.endpoint} has yet to set 'common_name'.")
-            return []
-
-        certs = []
-        cert = getattr(self._data, f"{self._unit_name}.server.cert", None)
-        key = getattr(self._data, f"{self._unit_name}.server.key", None)
-        if cert and key:
-            certs.append(
-                Certificate(
-                    cert_type="server",
-                    common_name=common_name,
-                    cert=cert,
-                    key=key,
-                    chain=self.chain,
-                )
-            )
-
-        field = f"{self._unit_name}.processed_requests"
-        certs_json = getattr(self._data, field, "{}")
-        certs_data = json.loads(certs_json)
-        return certs + [
-            Certificate(
-                cert_type="server",
-                common_name=common_name,
-                cert=cert_data.get("cert"),
-                key=cert_data.get("key"),
-                chain=self.chain,
-            )
-            for common_name, cert_data in certs_data.items()
-        ]
+        return list(self._snapshot.server.values())
 
     @property
     def server_certs_map(self) -> Mapping[str, Certificate]:
         """Certificate instances by their `common_name`."""
-        return {cert.common_name: cert for cert in self.server_certs}
+        return self._snapshot.server
+
+    @property
+    def application_certs(self) -> List[Certificate]:
+        """
+        List containing the Certificate instance of the application cert,
+        which is shared by all units, once it is available.  Its
+        `common_name` is always 'app_data'.
+        """
+        return list(self._snapshot.application.values())
+
+    def request_application_cert(
+        self,
+        cn: str,
+        sans: Optional[List[str]] = None,
+        key_type: Optional[str] = None,
+        key_size: Optional[int] = None,
+    ):
+        """Request an application certificate for charm.
+
+        Request an application certificate and key be generated for the given
+        common name (`cn`) and list of alternative names (`sans`) of this unit
+        and all peer units.  All units will share a single certificate, so
+        the CA only signs it once for the whole application.
+
+        The optional `key_type` and `key_size` are as for
+        `request_server_cert`.  The key is always generated by the CA, even
+        with `csr_mode` enabled, since it is shared by every unit.
+        """
+        options = key_options(key_type, key_size)
+        # all units of this application must use the same CA
+        relation = self._relation_for(self.model.app.name)
+        if not relation:
+            return
+        if self.fan_out:
+            self._drop_request(cn, "application_cert_requests", keep=relation)
+        data = relation.data[self.model.unit]
+        requests = json.loads(data.get("application_cert_requests", "{}"))
+        request = dict(options, sans=sans or [])
+        requests[cn] = self._stamp(request, requests.get(cn))
+        data["application_cert_requests"] = json.dumps(requests)
+        self.refresh()
 
     @property
     def intermediate_certs(self) -> List[Certificate]:
         """Certificate instances for all available intermediate CA certs."""
-        if not self.is_ready:
-            return []
-
-        field = f"{self._unit_name}.processed_intermediate_requests"
-        certs_json = getattr(self._data, field, "{}")
-        certs_data = json.loads(certs_json)
-        return [
-            Certificate(cert_type="intermediate", common_name=common_name, **cert)
-            for common_name, cert in certs_data.items()
-        ]
+        return list(self._snapshot.intermediate.values())
 
     @property
     def intermediate_certs_map(self) -> Mapping[str, Certificate]:
         """Certificate instances by their `common_name`."""
-        return {cert.common_name: cert for cert in self.intermediate_certs}
-
-    def request_intermediate_cert(self, cn: str, sans: Optional[List[str]] = None):
+        return self._snapshot.intermediate
+
+    def request_intermediate_cert(
+        self,
+        cn: str,
+        sans: Optional[List[str]] = None,
+        key_type: Optional[str] = None,
+        key_size: Optional[int] = None,
+    ):
         """Request intermediate CA certificate for charm.
 
         Request an intermediate CA certificate and key be generated for the given
@@ -236,11 +856,41 @@ class CertificatesRequires(Object):
         This can be called multiple times to request more than one intermediate CA
         certificate, although the common names must be unique.  If called
         again with the same common name, it will be ignored.
+
+        The optional `key_type` ('rsa', 'ecdsa' or 'ed25519') and `key_size`
+        select the algorithm of the private key; by default, the CA decides.
         """
-        if not self.relation:
+        options = key_options(key_type, key_size)
+        relation = self._relation_for(cn)
+        if not relation:
             return
-        # assume we'll only be connected to one provider
-        data = self.relation.data[self.model.unit]
+        if self.fan_out:
+            self._drop_request(cn, "intermediate_cert_requests", keep=relation)
+        data = relation.data[self.model.unit]
         requests = json.loads(data.get("intermediate_cert_requests", "{}"))
-        requests[cn] = {"sans": sans or []}
+        requests[cn] = self._stamp(dict(options, sans=sans or []), requests.get(cn))
         data["intermediate_cert_requests"] = json.dumps(requests)
+        self.refresh()
+
+    def withdraw_cert(self, cn: str, cert_type: Optional[str] = None):
+        """Withdraw the request for the given common name (`cn`).
+
+        The CA will then stop publishing its certificate.  If `cert_type` is
+        given, as one of 'server', 'client', 'application' or 'intermediate',
+        only that type of request is withdrawn.  Otherwise, requests of every
+        type with that common name are withdrawn.
+        """
+        if cert_type is not None and cert_type not in REQUEST_FIELDS:
+            raise ValueError(f"Unknown cert_type: {cert_type}")
+        self._stored.set_default(issued="{}")
+        issued = json.loads(self._stored.issued)
+        for request_type, field in REQUEST_FIELDS.items():
+            if cert_type in (None, request_type):
+                self._drop_request(cn, field)
+                # a later request for the same name is timed afresh
+                issued.pop(f"{request_type}.{cn}", None)
+                if self.csr_mode:
+                    self._stored.set_default(csr={})
+                    self._stored.csr.pop(f"{request_type}.{cn}", None)
+        self._stored.issued = json.dumps(issued)
+        self.refresh()
@@ -26,8 +26,10 @@ setup(
     version="0.1.0",
     zip_safe=True,
     install_requires=[
-        "backports.cached-property",
         "pydantic",
-        "ops",
+        "ops>=2.0",
     ],
+    extras_require={
+        "csr": ["cryptography"],
+    },
 )
@@ -0,0 +1,60 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import os
+from pathlib import Path
+
+import pytest
+from ops.interface_tls_certificates import write_certs
+from ops.interface_tls_certificates.model import Certificate
+
+
+@pytest.fixture()
+def certs():
+    yield [
+        Certificate("server", "my.service", "CERT-1", "KEY-1"),
+        Certificate("server", "system:kube-apiserver", "CERT-2", "KEY-2"),
+    ]
+
+
+def test_write_certs(certs, tmpdir):
+    target = Path(tmpdir) / "tls"
+    written = write_certs(certs, target)
+    assert sorted(written) == sorted(
+        str(target / name)
+        for name in (
+            "my.service.crt",
+            "my.service.key",
+            "system:kube-apiserver.crt",
+            "system:kube-apiserver.key",
+        )
+    )
+    assert (target / "my.service.crt").read_text() == "CERT-1"
+    assert (target / "my.service.key").read_text() == "KEY-1"
+    assert (target / "my.service.key").stat().st_mode & 0o777 == 0o600
+    assert not list(target.glob("*.tmp"))
+
+
+def test_write_certs_only_changed(certs, tmpdir):
+    target = Path(tmpdir)
+    write_certs(certs, target)
+    assert write_certs(certs, target) == []
+
+    certs[1] = Certificate("server", "system:kube-apiserver", "CERT-3", "KEY-2")
+    assert write_certs(certs, target) == [str(target / "system:kube-apiserver.crt")]
+    assert (target / "system:kube-apiserver.crt").read_text() == "CERT-3"
+
+
+def test_write_certs_missing_file(certs, tmpdir):
+    target = Path(tmpdir)
+    write_certs(certs, target)
+    os.remove(target / "my.service.key")
+    assert write_certs(certs, target) == [str(target / "my.service.key")]
+
+
+def test_write_certs_syncs_files(certs, tmpdir, monkeypatch):
+    synced = []
+    monkeypatch.setattr(os, "fsync", synced.append)
+    monkeypatch.setattr(os, "sync", pytest.fail)
+    write_certs(certs, Path(tmpdir))
+    # each of the four files and the index, and then the directory once
+    assert len(synced) == 6
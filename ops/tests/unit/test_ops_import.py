@@ -0,0 +1,46 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import subprocess
+import sys
+
+import pytest
+
+# modules which must not be imported until the relation data is used
+DEFERRED = ("pydantic", "cryptography", "ops.interface_tls_certificates.model")
+
+
+def import_times(statement):
+    """Cumulative import times in microseconds by module, from -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split(":", 1)[1].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "import ops.interface_tls_certificates",
+        "from ops.interface_tls_certificates import CertificatesRequires",
+        "from ops.interface_tls_certificates import write_certs",
+    ],
+)
+def test_import_defers_models(statement):
+    times = import_times(statement)
+    assert "ops.interface_tls_certificates" in times
+    deferred = [
+        name
+        for name in times
+        if any(name == module or name.startswith(module + ".") for module in DEFERRED)
+    ]
+    assert deferred == []
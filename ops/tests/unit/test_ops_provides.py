@@ -0,0 +1,408 @@
+# Copyright 2023 Canonical Ltd.
+# See LICENSE file for licensing details.
+import json
+
+import pytest
+from ops.charm import CharmBase
+from ops.model import SecretNotFoundError
+from ops.interface_tls_certificates import CertificatesProvides, CertificatesRequires
+from ops.testing import Harness
+
+
+class CACharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.certificates = CertificatesProvides(self)
+        self.requested = 0
+        self.framework.observe(
+            self.certificates.on.certificates_requested, self._on_requested
+        )
+
+    def _on_requested(self, event):
+        self.requested += 1
+
+
+class ClientCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.certificates = CertificatesRequires(self)
+
+
+@pytest.fixture()
+def provider():
+    harness = Harness(
+        CACharm,
+        meta="""
+        name: easyrsa
+        provides:
+          certificates:
+            interface: tls-certificates
+        """,
+    )
+    harness.begin()
+    yield harness
+    harness.cleanup()
+
+
+@pytest.fixture()
+def requirer():
+    harness = Harness(
+        ClientCharm,
+        meta="""
+        name: test
+        requires:
+          certificates:
+            interface: tls-certificates
+        """,
+    )
+    harness.begin()
+    yield harness
+    harness.cleanup()
+
+
+def request_data(unit_name):
+    return {
+        "unit_name": unit_name,
+        "common_name": "server-0",
+        "sans": json.dumps(["Server-0.Example.", "10.0.0.1"]),
+        "certificate_name": "server-0",
+        "cert_requests": json.dumps({"server-1": {"sans": []}}),
+        "client_cert_requests": json.dumps({"client": {"sans": None}}),
+        "application_cert_requests": json.dumps({unit_name: {"sans": ["app"]}}),
+    }
+
+
+def test_new_requests(provider):
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    provider.update_relation_data(rel_id, "test/0", request_data("test_0"))
+    certificates = provider.charm.certificates
+    assert provider.charm.requested == 1
+
+    server = {r.common_name: r for r in certificates.new_server_requests}
+    assert set(server) == {"server-0", "server-1"}
+    assert server["server-0"].legacy
+    assert server["server-0"].sans == ("10.0.0.1", "server-0.example")
+    assert [r.common_name for r in certificates.new_client_requests] == ["client"]
+    (app,) = certificates.new_application_requests
+    assert app.units == ("test_0",)
+    assert app.sans == ("app", "test_0")
+    assert certificates.new_intermediate_requests == []
+    assert len(certificates.new_requests) == len(certificates.all_requests) == 4
+
+
+def test_reactive_requests(provider):
+    # the reactive requirer JSON-encodes all but its names
+    csr = (
+        "-----BEGIN CERTIFICATE REQUEST-----\nCSR\n-----END CERTIFICATE REQUEST-----\n"
+    )
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    data = {
+        "unit_name": "test_0",
+        "common_name": "server-0",
+        "certificate_name": "server-0",
+        "sans": json.dumps(["10.0.0.1", "Server-0"]),
+        "csr": json.dumps(csr),
+        "key_type": json.dumps("ecdsa"),
+        "key_size": json.dumps(256),
+        "requested_at": json.dumps(1700000000.0),
+    }
+    provider.update_relation_data(rel_id, "test/0", data)
+    (request,) = provider.charm.certificates.new_requests
+    assert request.legacy
+    assert request.csr == csr
+    assert (request.key_type, request.key_size) == ("ecdsa", 256)
+    assert request.sans == ("10.0.0.1", "server-0")
+    assert request.requested_at == 1700000000.0
+
+    provider.charm.certificates.set_cert(request, "cert", "key")
+    assert provider.charm.certificates.new_requests == []
+    published = provider.get_relation_data(rel_id, "easyrsa/0")
+    assert published["test_0.server.cert"] == "cert"
+
+
+def test_set_certs(provider):
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    provider.add_relation_unit(rel_id, "test/1")
+    provider.update_relation_data(rel_id, "test/0", request_data("test_0"))
+    provider.update_relation_data(rel_id, "test/1", request_data("test_1"))
+    certificates = provider.charm.certificates
+    requests = certificates.new_requests
+    assert len(requests) == 7
+
+    written = certificates.set_certs(
+        (request, f"cert-{request.key}", f"key-{request.key}") for request in requests
+    )
+    # each unit's server cert and key, server, client and application certs
+    assert written == 2 * 5
+    assert certificates.new_requests == []
+    data = provider.get_relation_data(rel_id, "easyrsa/0")
+    assert data["test_0.server.cert"] == f"cert-{rel_id}/test_0/server/server-0"
+    processed = json.loads(data["test_1.processed_requests"])
+    assert processed == {
+        "server-1": {
+            "cert": f"cert-{rel_id}/test_1/server/server-1",
+            "key": f"key-{rel_id}/test_1/server/server-1",
+        }
+    }
+    app_data = json.loads(data["test_0.processed_application_requests"])
+    assert app_data == json.loads(data["test_1.processed_application_requests"])
+    assert app_data["app_data"]["cert"] == f"cert-{rel_id}/test/application/test_0"
+
+    # only changed requests are new again
+    provider.charm.requested = 0
+    changed = dict(request_data("test_1"), sans=json.dumps(["server-0.example"]))
+    provider.update_relation_data(rel_id, "test/1", changed)
+    assert provider.charm.requested == 1
+    assert [r.key for r in certificates.new_requests] == [
+        f"{rel_id}/test_1/server/server-0"
+    ]
+    provider.update_relation_data(rel_id, "test/0", {"unit_name": "test_0"})
+    assert provider.charm.requested == 1
+
+
+def test_withdrawn_certs_are_pruned(provider):
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    provider.update_relation_data(rel_id, "test/0", request_data("test_0"))
+    certificates = provider.charm.certificates
+    certificates.set_certs(
+        (request, "cert", "key") for request in certificates.new_requests
+    )
+
+    # withdraw all but the client cert, then request a new server cert
+    provider.update_relation_data(
+        rel_id,
+        "test/0",
+        {
+            "common_name": "",
+            "sans": "",
+            "certificate_name": "",
+            "application_cert_requests": "",
+            "cert_requests": json.dumps({"server-2": {"sans": []}}),
+        },
+    )
+    [request] = certificates.new_requests
+    certificates.set_cert(request, "cert-2", "key-2")
+    data = provider.get_relation_data(rel_id, "easyrsa/0")
+    assert json.loads(data["test_0.processed_requests"]) == {
+        "server-2": {"cert": "cert-2", "key": "key-2"}
+    }
+    assert "client" in json.loads(data["test_0.processed_client_requests"])
+    assert "test_0.server.cert" not in data
+    assert "test_0.processed_application_requests" not in data
+
+
+def test_queue_status(provider):
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    provider.update_relation_data(rel_id, "test/0", request_data("test_0"))
+    certificates = provider.charm.certificates
+    data = provider.get_relation_data(rel_id, "easyrsa/0")
+    assert json.loads(data["queue_status"]) == {"pending": 4, "retry_after": None}
+
+    certificates.set_cert(certificates.new_requests[0], "cert", "key")
+    status = json.loads(data["queue_status"])
+    assert status["pending"] == 3
+    assert isinstance(status["retry_after"], int)
+
+
+def test_set_ca(provider):
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    certificates = provider.charm.certificates
+    assert certificates.set_ca("CA") == 1
+    assert certificates.set_ca("CA") == 0
+    assert certificates.set_chain("CHAIN") == 1
+    data = provider.get_relation_data(rel_id, "easyrsa/0")
+    assert data["ca"] == "CA"
+    assert data["chain"] == "CHAIN"
+
+
+def test_relation_broken(provider):
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    provider.update_relation_data(rel_id, "test/0", request_data("test_0"))
+    certificates = provider.charm.certificates
+    certificates.set_certs((r, "cert", "key") for r in certificates.new_requests)
+    assert len(certificates._stored.fingerprints) == 4
+    provider.remove_relation(rel_id)
+    assert len(certificates._stored.fingerprints) == 0
+
+
+def test_round_trip(provider, requirer):
+    req_id = requirer.add_relation("certificates", "easyrsa")
+    requirer.add_relation_unit(req_id, "easyrsa/0")
+    requirer.charm.certificates.request_server_cert("server-0", ["server-0.example"])
+    requirer.charm.certificates.request_server_cert("server-1")
+    requirer.charm.certificates.request_client_cert("client")
+    requirer.charm.certificates.request_application_cert("test", ["test.local"])
+
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    provider.update_relation_data(
+        rel_id, "test/0", requirer.get_relation_data(req_id, "test/0")
+    )
+    certificates = provider.charm.certificates
+    certificates.set_ca("CA")
+    certificates.set_client_cert("CLIENT", "CLIENT-KEY")
+    certificates.set_certs(
+        (r, f"cert-{r.common_name}", "key") for r in certificates.new_requests
+    )
+
+    requirer.update_relation_data(
+        req_id, "easyrsa/0", provider.get_relation_data(rel_id, "easyrsa/0")
+    )
+    assert requirer.charm.certificates.is_ready
+    server = requirer.charm.certificates.server_certs_map
+    assert {cn: cert.cert for cn, cert in server.items()} == {
+        "server-0": "cert-server-0",
+        "server-1": "cert-server-1",
+    }
+    (client,) = requirer.charm.certificates.client_certs
+    assert client.cert == "cert-client"
+    (app,) = requirer.charm.certificates.application_certs
+    assert (app.common_name, app.cert) == ("app_data", "cert-test")
+
+
+def test_digest(provider, requirer):
+    req_id = requirer.add_relation("certificates", "easyrsa")
+    requirer.add_relation_unit(req_id, "easyrsa/0")
+    requirer.charm.certificates.request_server_cert("server-0")
+
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    provider.add_relation_unit(rel_id, "test/1")
+    provider.update_relation_data(
+        rel_id, "test/0", requirer.get_relation_data(req_id, "test/0")
+    )
+    provider.update_relation_data(rel_id, "test/1", request_data("test_1"))
+    certificates = provider.charm.certificates
+    certificates.set_ca("CA")
+    certificates.set_client_cert("CLIENT", "CLIENT-KEY")
+    certificates.set_certs((r, "cert", "key") for r in certificates.new_requests)
+    data = provider.get_relation_data(rel_id, "easyrsa/0")
+    assert data["test_0.digest"] != data["test_1.digest"]
+
+    requirer.update_relation_data(req_id, "easyrsa/0", data)
+    assert "_snapshot" in requirer.charm.certificates._cache
+
+    # only the certs of another unit change
+    certificates.set_certs(
+        (r, "new", "key") for r in certificates.all_requests if r.unit_name == "test_1"
+    )
+    data = provider.get_relation_data(rel_id, "easyrsa/0")
+    requirer.update_relation_data(req_id, "easyrsa/0", data)
+    assert "_snapshot" not in requirer.charm.certificates._cache
+    assert requirer.charm.certificates.server_certs[0].cert == "cert"
+
+
+def test_unit_departed(provider):
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    provider.add_relation_unit(rel_id, "remote-1234/1")
+    provider.update_relation_data(rel_id, "test/0", request_data("test_0"))
+    # a unit of another model publishes its name in the requirer's model
+    provider.update_relation_data(rel_id, "remote-1234/1", request_data("test_1"))
+    certificates = provider.charm.certificates
+    certificates.set_certs((r, "cert", "key") for r in certificates.new_requests)
+
+    provider.remove_relation_unit(rel_id, "remote-1234/1")
+    data = provider.get_relation_data(rel_id, "easyrsa/0")
+    assert not [key for key in data if key.startswith("test_1.")]
+    assert "test_0.digest" in data
+    assert not [key for key in certificates._stored.fingerprints if "test_1" in key]
+
+
+class SecretsCACharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.certificates = CertificatesProvides(self, use_secrets=True)
+
+
+def test_secrets(requirer):
+    provider = Harness(
+        SecretsCACharm,
+        meta="""
+        name: easyrsa
+        provides:
+          certificates:
+            interface: tls-certificates
+        """,
+    )
+    provider.begin()
+    rel_id = provider.add_relation("certificates", "test")
+    provider.add_relation_unit(rel_id, "test/0")
+    provider.add_relation_unit(rel_id, "test/1")
+    provider.update_relation_data(rel_id, "test/0", request_data("test_0"))
+    provider.update_relation_data(rel_id, "test/1", request_data("test_1"))
+    certificates = provider.charm.certificates
+    certificates.set_ca("CA")
+    certificates.set_client_cert("CLIENT", "CLIENT-KEY")
+    certificates.set_certs(
+        (r, f"cert-{r.unit_name}", f"key-{r.unit_name}")
+        for r in certificates.new_requests
+    )
+
+    # only the secret IDs and digests are in the relation data
+    data = provider.get_relation_data(rel_id, "easyrsa/0")
+    assert sorted(key for key in data if key.startswith("test_0.")) == [
+        "test_0.digest",
+        "test_0.secret",
+    ]
+    secret_id = data["test_0.secret"]
+    assert provider.get_secret_grants(secret_id, rel_id) == {"test/0"}
+    content = json.loads(
+        provider.model.get_secret(id=secret_id).peek_content()["certs"]
+    )
+    assert content["server.cert"] == "cert-test_0"
+    assert json.loads(content["processed_requests"]) == {
+        "server-1": {"cert": "cert-test_0", "key": "key-test_0"}
+    }
+
+    # the requirer reads its certs from the secret, only when they change
+    req_id = requirer.add_relation("certificates", "easyrsa")
+    requirer.add_relation_unit(req_id, "easyrsa/0")
+    secret_id = requirer.add_model_secret("easyrsa", {"certs": json.dumps(content)})
+    requirer.grant_secret(secret_id, "test")
+    requirer.update_relation_data(req_id, "test/0", {"common_name": "server-0"})
+    requirer.update_relation_data(
+        req_id, "easyrsa/0", dict(data, **{"test_0.secret": secret_id})
+    )
+    server = requirer.charm.certificates.server_certs_map
+    assert {cn: cert.cert for cn, cert in server.items()} == {
+        "server-0": "cert-test_0",
+        "server-1": "cert-test_0",
+    }
+    requirer.set_secret_content(secret_id, {"certs": json.dumps({})})
+    requirer.charm.certificates.refresh()
+    assert len(requirer.charm.certificates.server_certs) == 2
+
+    # the cached content of a secret which is no longer published is dropped
+    requirer.update_relation_data(req_id, "easyrsa/0", {"test_0.secret": ""})
+    requirer.charm.certificates.server_certs
+    assert json.loads(requirer.charm.certificates._stored.secrets) == {}
+
+    provider.remove_relation_unit(rel_id, "test/1")
+    with pytest.raises(SecretNotFoundError):
+        provider.model.get_secret(label=f"certificates-{rel_id}-test_1")
+    data = provider.get_relation_data(rel_id, "easyrsa/0")
+    assert not [key for key in data if key.startswith("test_1.")]
+    assert dict(certificates._stored.secrets) == {str(rel_id): ["test_0"]}
+
+    # a unit which comes back with the same name gets a new secret
+    provider.add_relation_unit(rel_id, "test/1")
+    provider.update_relation_data(rel_id, "test/1", request_data("test_1"))
+    certificates.set_certs((r, "cert", "key") for r in certificates.new_requests)
+    data = provider.get_relation_data(rel_id, "easyrsa/0")
+    assert provider.get_secret_grants(data["test_1.secret"], rel_id) == {"test/1"}
+
+    # all of the secrets are removed with the relation
+    provider.remove_relation(rel_id)
+    for unit_name in ("test_0", "test_1"):
+        with pytest.raises(SecretNotFoundError):
+            provider.model.get_secret(label=f"certificates-{rel_id}-{unit_name}")
+    assert dict(certificates._stored.secrets) == {}
+    provider.cleanup()
@@ -4,12 +4,48 @@ if not __package__:
 
     __package__ = sys.modules[""].__name__
 
+import asyncio
+import hashlib
+import math
+import os
+import time
+from collections import Counter
+
+from charmhelpers.core import hookenv, unitdata
+
 from charms.reactive import Endpoint
 from charms.reactive import when, when_not
 from charms.reactive import set_flag, clear_flag, toggle_flag
 
 from .tls_certificates_common import ApplicationCertificateRequest, CertificateRequest
 
+# fields published for each requirer unit, prefixed by the unit's name
+UNIT_FIELDS = (
+    "server.cert",
+    "server.key",
+    "processed_requests",
+    "processed_client_requests",
+    "processed_application_requests",
+    "processed_intermediate_requests",
+)
+
+# fields of the requests from each requirer unit, which its digest covers
+REQUEST_FIELDS = (
+    "unit_name",
+    "common_name",
+    "certificate_name",
+    "sans",
+    "csr",
+    "key_type",
+    "key_size",
+    "requested_at",
+    "request_seq",
+    "cert_requests",
+    "client_cert_requests",
+    "application_cert_requests",
+    "intermediate_cert_requests",
+)
+
 
 class TlsProvides(Endpoint):
     """
@@ -40,17 +76,59 @@ class TlsProvides(Endpoint):
         When there are new intermediate CA certificate requests to be processed.
         The requests can be accessed via [new_intermediate_requests][].
 
+    At the end of each hook, the number of requests still pending and an
+    estimate of how long they will take to be handled are published to all
+    related applications, so that they can hold off dependent work.  A
+    digest of the certs of each requirer unit is published next to them as
+    well, so that the requirers can skip decoding them when it is unchanged.
+
+    Every cert which is set is first recorded in an issuance journal, which
+    is written through to disk immediately.  If the hook fails before the
+    certs are published, they are published from the journal in the next
+    hook on this unit, rather than the requests being left for the charm to
+    sign again.  The journal only recovers from failed hooks: it holds the
+    private keys of the certs, so it is kept on this unit's disk, readable
+    only by its owner, and is never shared with the other units.  If another
+    unit takes over signing, for example after a leader failover, the
+    requests whose certs were lost are signed again there.
+
+    A new CA can be rolled out gradually with [rotate_ca][], in which case
+    the existing certs are reissued in waves of units, by including them in
+    [new_requests][] again, while both the old and new CA are published.
+
     [Certificate]: common.md#tls_certificates_common.Certificate
     [CertificateRequest]: common.md#tls_certificates_common.CertificateRequest
     [all_requests]: provides.md#provides.TlsProvides.all_requests
     [new_requests]: provides.md#provides.TlsProvides.new_requests
     [new_server_requests]: provides.md#provides.TlsProvides.new_server_requests
     [new_client_requests]: provides.md#provides.TlsProvides.new_client_requests
+    [AsyncSigner]: common.md#tls_certificates_common.AsyncSigner
+    [rotate_ca]: provides.md#provides.TlsProvides.rotate_ca
+    [ca_rotation]: provides.md#provides.TlsProvides.ca_rotation
+    [set_ca]: provides.md#provides.TlsProvides.set_ca
     """
 
+    def __init__(self, endpoint_name, relation_ids=None):
+        super().__init__(endpoint_name, relation_ids)
+        self._index = None
+        self._rotation = None
+        self._handled_at = None
+        self._atexit_pending = False
+        self._journal_db = None
+        self._request_entries = None
+        self._published = {}
+
     @when("endpoint.{endpoint_name}.joined")
     def joined(self):
         set_flag(self.expand_name("{endpoint_name}.available"))
+        self.prune_withdrawn_certs()
+        self._advance_ca_rotation()
+        self._replay_journal()
+        if not self._atexit_pending:
+            # publish once the charm has handled what it can in this hook
+            hookenv.atexit(self._publish_queue_status)
+            hookenv.atexit(self._publish_digests)
+            self._atexit_pending = True
         toggle_flag(
             self.expand_name("{endpoint_name}.certs.requested"), self.new_requests
         )
@@ -80,6 +158,10 @@ class TlsProvides(Endpoint):
             self.new_client_requests,
         )
 
+    @when("endpoint.{endpoint_name}.departed")
+    def departed(self):
+        self.prune_departed_units()
+
     @when_not("endpoint.{endpoint_name}.joined")
     def broken(self):
         clear_flag(self.expand_name("{endpoint_name}.available"))
@@ -89,21 +171,373 @@ class TlsProvides(Endpoint):
         clear_flag(self.expand_name("{endpoint_name}.application.certs.requested"))
         clear_flag(self.expand_name("{endpoint_name}.intermediate.certs.requested"))
 
+    def prune_withdrawn_certs(self):
+        """
+        Remove the published certs for any requests which have since been
+        withdrawn, so that the relation data only grows with the number of
+        requested certificates.
+
+        This is done automatically, and returns the number of certs removed.
+        Only the units whose requests have changed since they were last
+        indexed need their requests to be decoded.  The application cert is
+        shared by every unit, so each unit's application certs are checked
+        against the application requests of all units whenever any of them
+        change.
+        """
+        removed = 0
+        stored = self._stored_request_entries
+        for relation in self.relations:
+            changed = {
+                unit.unit_name
+                for unit in relation.joined_units
+                if self._request_digest(unit, REQUEST_FIELDS)
+                != (stored.get(self._unit_entry_name(unit)) or {}).get("digest")
+            }
+            joined = {self._unit_entry_name(unit) for unit in relation.joined_units}
+            departed = [
+                name
+                for name in stored
+                if name.split("/", 1)[0] == relation.relation_id and name not in joined
+            ]
+            app_names = None
+            if changed or departed:
+                # the application cert is shared by the requests of every unit
+                app_names = set()
+                for unit in relation.joined_units:
+                    app_names.update(unit.received["application_cert_requests"] or {})
+                if app_names:
+                    app_names.add("app_data")
+            for unit in relation.joined_units:
+                unit_name = CertificateRequest.resolve_unit_name(unit)
+                unit_name = unit_name.replace("/", "_")
+                requested = {}
+                if unit.unit_name in changed:
+                    requested = {
+                        "processed_requests": unit.received["cert_requests"],
+                        "processed_client_requests": unit.received[
+                            "client_cert_requests"
+                        ],
+                        "processed_intermediate_requests": unit.received[
+                            "intermediate_cert_requests"
+                        ],
+                    }
+                if app_names is not None:
+                    requested["processed_application_requests"] = app_names
+                for field, requests in requested.items():
+                    key = "{}.{}".format(unit_name, field)
+                    certs_data = self._published_certs(relation, key)
+                    if not certs_data:
+                        continue
+                    stale = [cn for cn in certs_data if cn not in (requests or {})]
+                    for cn in stale:
+                        del certs_data[cn]
+                    if stale and certs_data:
+                        relation.to_publish[key] = certs_data
+                    elif stale:
+                        relation.to_publish_raw[key] = None
+                    removed += len(stale)
+                to_publish_raw = relation.to_publish_raw
+                if not unit.received_raw["common_name"]:
+                    server_cert_key = "{}.server.cert".format(unit_name)
+                    if to_publish_raw[server_cert_key]:
+                        to_publish_raw[server_cert_key] = None
+                        to_publish_raw["{}.server.key".format(unit_name)] = None
+                        removed += 1
+        if removed:
+            hookenv.log("Removed {} withdrawn certs".format(removed))
+        return removed
+
+    def prune_departed_units(self):
+        """
+        Remove the published certs and keys of all units which have departed
+        since this was last done.
+
+        This is done automatically, and returns the number of bytes of relation
+        data which were removed.  The departed units are left in
+        `all_departed_units` for the charm; the ones already pruned are
+        tracked separately.
+        """
+        kv = unitdata.kv()
+        key = self.expand_name("{endpoint_name}.pruned-departed-units")
+        pruned = set(kv.get(key) or [])
+        relation_ids = set(hookenv.relation_ids(self.endpoint_name))
+        relations = {relation.relation_id: relation for relation in self.relations}
+        departed, reclaimed = set(), 0
+        for unit in self.all_departed_units:
+            relation_id = unit.relation.relation_id
+            name = "{}/{}".format(relation_id, unit.unit_name)
+            departed.add(name)
+            if name in pruned:
+                continue
+            if relation_id not in relation_ids:
+                # the whole relation is gone, along with its data
+                pruned.add(name)
+                continue
+            relation = relations.get(relation_id)
+            if relation is None:
+                # the last unit has departed, so the relation is no longer
+                # in self.relations, and its data isn't flushed with them
+                relation = relations[relation_id] = unit.relation
+                hookenv.atexit(relation._flush_data)
+            unit_name = CertificateRequest.resolve_unit_name(unit).replace("/", "_")
+            if unit_name in self._joined_unit_names(relation):
+                # the same unit has joined again since
+                continue
+            to_publish_raw = relation.to_publish_raw
+            for field in UNIT_FIELDS + ("digest",):
+                data_key = "{}.{}".format(unit_name, field)
+                value = to_publish_raw[data_key]
+                if value:
+                    to_publish_raw[data_key] = None
+                    reclaimed += len(data_key) + len(value)
+            pruned.add(name)
+        # forget the units which the charm has removed from all_departed_units
+        kv.set(key, sorted(pruned & departed))
+        if reclaimed:
+            hookenv.log("Removed {} bytes for departed units".format(reclaimed))
+        return reclaimed
+
+    @staticmethod
+    def _joined_unit_names(relation):
+        return {
+            CertificateRequest.resolve_unit_name(unit).replace("/", "_")
+            for unit in relation.joined_units
+        }
+
+    def process_new_requests_async(self, signer, concurrency=8):
+        """
+        Issue the certs for all [new_requests][] with an [AsyncSigner][],
+        such as one fronting an external CA.
+
+        Up to `concurrency` signing calls are made at once, and each cert is
+        published as soon as it is returned.  A failure to sign or publish
+        one request, including a result of the wrong shape, doesn't affect
+        the others; the list of `(request, error)` pairs for the requests
+        which failed is returned, and they remain in [new_requests][].
+        """
+        errors = []
+
+        async def sign(request, semaphore):
+            async with semaphore:
+                if request._index_key not in self._pending_requests:
+                    # handled along with another request, such as the other
+                    # requests for the same application cert
+                    return
+                try:
+                    result = await signer.sign(request)
+                    cert, key = (result, None) if request.csr else result
+                    request.set_cert(cert, key)
+                except Exception as e:
+                    hookenv.log(
+                        "Failed to sign {} cert for {}: {}".format(
+                            request.cert_type, request.common_name, e
+                        ),
+                        hookenv.ERROR,
+                    )
+                    errors.append((request, e))
+
+        async def sign_all():
+            semaphore = asyncio.Semaphore(concurrency)
+            await asyncio.gather(
+                *(sign(request, semaphore) for request in self.new_requests)
+            )
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(sign_all())
+        finally:
+            loop.close()
+        return errors
+
+    def _publish_digests(self):
+        """
+        Publish a digest of the certs of each requirer unit next to them, so
+        that the requirer can tell that its certs are unchanged without
+        decoding them.
+        """
+        for relation in self.relations:
+            to_publish_raw = relation.to_publish_raw
+            for unit in relation.joined_units:
+                unit_name = CertificateRequest.resolve_unit_name(unit)
+                unit_name = unit_name.replace("/", "_")
+                values = [
+                    to_publish_raw["{}.{}".format(unit_name, field)] or ""
+                    for field in UNIT_FIELDS
+                ]
+                digest = None
+                if any(values):
+                    content = "\n".join(values).encode("utf8")
+                    digest = hashlib.sha256(content).hexdigest()[:16]
+                key = "{}.digest".format(unit_name)
+                if to_publish_raw[key] != digest:
+                    to_publish_raw[key] = digest
+
+    def _publish_queue_status(self):
+        """
+        Publish the number of pending requests, and the estimated seconds
+        until they have been handled, based on the average time per request.
+        """
+        pending = len(self._pending_requests)
+        seconds = unitdata.kv().get(self.expand_name("{endpoint_name}.request-time"))
+        retry_after = None
+        if seconds is not None:
+            retry_after = int(round(pending * seconds))
+        status = {"pending": pending, "retry_after": retry_after}
+        for relation in self.relations:
+            if relation.to_publish.get("queue_status") != status:
+                relation.to_publish["queue_status"] = status
+
+    def rotate_ca(
+        self, certificate_authority, chain=None, wave_size=None, wave_percent=10
+    ):
+        """
+        Start a staged rollout of a new CA, rather than publishing it with
+        [set_ca][] and reissuing every cert at once.
+
+        Until the rollout completes, the old and new CA are both published
+        as a bundle, and in each hook the certs of up to `wave_size` units,
+        or `wave_percent` of the units if no size is given, are included in
+        [new_requests][] again to be reissued with the new CA.  Once they
+        have all been reissued, only the new CA and `chain` are published.
+        Progress is kept in the unit's local state and is reported by
+        [ca_rotation][].
+        """
+        old_ca = None
+        for relation in self.relations:
+            old_ca = relation.to_publish_raw["ca"] or old_ca
+        if self._rotation_state:
+            # a rollout which was still in progress is superseded
+            old_ca = self._rotation_state["old_ca"]
+        kv = unitdata.kv()
+        if not old_ca or old_ca == certificate_authority:
+            kv.unset(self.expand_name("{endpoint_name}.ca-rotation"))
+            self.set_ca(certificate_authority)
+            if chain is not None:
+                self.set_chain(chain)
+            return
+        rotation = {
+            "old_ca": old_ca,
+            "new_ca": certificate_authority,
+            "chain": chain,
+            "wave_size": wave_size,
+            "wave_percent": wave_percent,
+            "done": [],
+        }
+        kv.set(self.expand_name("{endpoint_name}.ca-rotation"), rotation)
+        self._rotation = rotation
+        self._index = None
+        self.set_ca(certificate_authority)
+
+    @property
+    def _rotation_state(self):
+        if self._rotation is None:
+            key = self.expand_name("{endpoint_name}.ca-rotation")
+            self._rotation = unitdata.kv().get(key) or {}
+        return self._rotation
+
+    @property
+    def ca_rotation(self):
+        """
+        Progress of the CA rollout started by [rotate_ca][], as a dict with
+        the number of units whose certs have been reissued as `done` out of
+        the `total`, or None if no rollout is in progress.
+        """
+        if not self._rotation_state:
+            return None
+        self._build_request_index()
+        units = self._rotation_units()
+        remaining = self._remaining_rotation_units(units)
+        return {"done": len(units) - len(remaining), "total": len(units)}
+
+    def _rotation_units(self):
+        units = {}
+        for key in self._index:
+            units.setdefault(key[:2], []).append(key)
+        return units
+
+    def _remaining_rotation_units(self, units):
+        done = set(self._rotation_state["done"])
+        return [
+            unit
+            for unit, keys in sorted(units.items())
+            if any("/".join(key) not in done for key in keys)
+        ]
+
+    def _rotation_wave(self):
+        """
+        The units whose certs should be reissued in this hook.
+        """
+        rotation = self._rotation_state
+        units = self._rotation_units()
+        size = rotation["wave_size"]
+        if not size:
+            size = math.ceil(len(units) * rotation["wave_percent"] / 100)
+        return self._remaining_rotation_units(units)[: max(1, size)]
+
+    def _advance_ca_rotation(self):
+        """
+        Complete the CA rollout once every unit's certs have been reissued.
+        """
+        rotation = self._rotation_state
+        if not rotation:
+            return
+        self._build_request_index()
+        if self._remaining_rotation_units(self._rotation_units()):
+            return
+        unitdata.kv().unset(self.expand_name("{endpoint_name}.ca-rotation"))
+        self._rotation = {}
+        self.set_ca(rotation["new_ca"])
+        if rotation["chain"] is not None:
+            self.set_chain(rotation["chain"])
+        hookenv.log("Completed rollout of new CA")
+
     def set_ca(self, certificate_authority):
         """
         Publish the CA to all related applications.
+
+        While a rollout started by [rotate_ca][] is in progress, the old and
+        new CA are published together instead.
+
+        Returns the number of relations which were updated.
         """
-        for relation in self.relations:
-            # All the clients get the same CA, so send it to them.
-            relation.to_publish_raw["ca"] = certificate_authority
+        rotation = self._rotation_state
+        if rotation:
+            certificate_authority = "\n".join(
+                (rotation["old_ca"].strip(), rotation["new_ca"].strip())
+            )
+        # All the clients get the same CA, so send it to them.
+        return self._publish_to_all("ca", certificate_authority)
 
     def set_chain(self, chain):
         """
         Publish the chain of trust to all related applications.
+
+        Returns the number of relations which were updated.
         """
+        # All the clients get the same chain, so send it to them.
+        return self._publish_to_all("chain", chain)
+
+    def _publish_to_all(self, field, value):
+        """
+        Publish a value to every relation which it hasn't already been sent to,
+        tracked by a hash of the value sent to each relation, so that unchanged
+        values aren't written again and new relations receive the current one.
+
+        Returns the number of relations which were updated.
+        """
+        kv = unitdata.kv()
+        key = self.expand_name("{endpoint_name}.published." + field)
+        sent = kv.get(key) or {}
+        digest = hashlib.sha256((value or "").encode("utf8")).hexdigest()
+        published, updated = {}, 0
         for relation in self.relations:
-            # All the clients get the same chain, so send it to them.
-            relation.to_publish_raw["chain"] = chain
+            if sent.get(relation.relation_id) != digest:
+                relation.to_publish_raw[field] = value
+                updated += 1
+            published[relation.relation_id] = digest
+        if published != sent:
+            kv.set(key, published)
+        return updated
 
     def set_client_cert(self, cert, key):
         """
@@ -124,9 +558,14 @@ class TlsProvides(Endpoint):
         Deprecated.  Use one of the [new_requests][] collections and
         `request.set_cert()` instead.
 
-        Set the server cert and key for the request identified by `scope`.
+        Set the server cert and key for the request identified by `scope`,
+        which must be one of the [new_server_requests][].
         """
-        request = self.get_server_requests()[scope]
+        self._build_request_index()
+        request = self._scopes.get(scope)
+        if request is None or request._index_key not in self._pending:
+            # as with the requests from get_server_requests()
+            raise KeyError(scope)
         request.set_cert(cert, key)
 
     def set_server_multicerts(self, scope):
@@ -152,6 +591,388 @@ class TlsProvides(Endpoint):
         """
         return {req._key: req for req in self.new_server_requests}
 
+    @staticmethod
+    def _unit_entry_name(unit):
+        return "{}/{}".format(unit.relation.relation_id, unit.unit_name)
+
+    @staticmethod
+    def _request_digest(unit, fields):
+        values = (unit.received_raw[field] or "" for field in fields)
+        return hashlib.sha256("\n".join(values).encode("utf8")).hexdigest()
+
+    @staticmethod
+    def _request_from_args(unit, args):
+        """
+        Rebuild a request of a unit from the arguments stored in the index.
+        """
+        cert_type, cert_name, common_name, sans = args[:4]
+        cls = CertificateRequest
+        if cert_type == "application":
+            cls = ApplicationCertificateRequest
+        csr, key_type, key_size, requested_at, request_seq = args[4:]
+        return cls(
+            unit,
+            cert_type,
+            cert_name,
+            common_name,
+            sans,
+            csr=csr,
+            key_type=key_type,
+            key_size=key_size,
+            requested_at=requested_at,
+            request_seq=request_seq,
+        )
+
+    @staticmethod
+    def _request_args(request):
+        """
+        The arguments to rebuild a request from, as stored in the index.
+        """
+        return [
+            request.cert_type,
+            request.cert_name,
+            request.common_name,
+            request._requested_sans,
+            request.csr,
+            request.key_type,
+            request.key_size,
+            request.requested_at,
+            request.request_seq,
+        ]
+
+    @property
+    def _stored_request_entries(self):
+        """
+        The requests of each unit as indexed by the previous hook.
+        """
+        if self._request_entries is None:
+            prefix = self.expand_name("{endpoint_name}.requests.")
+            self._request_entries = unitdata.kv().getrange(prefix, strip=True)
+        return self._request_entries
+
+    def _published_certs(self, relation, key):
+        """
+        The certs published in a field of a relation, which are only decoded
+        once per hook.  The same dict is returned each time, and is updated
+        in place as certs are set or pruned.
+        """
+        cache_key = (relation.relation_id, key)
+        if cache_key not in self._published:
+            self._published[cache_key] = relation.to_publish.get(key) or {}
+        return self._published[cache_key]
+
+    def _load_requests(self):
+        """
+        Build the requests of every joined unit, and whether each is pending.
+
+        The requests of each unit are kept in a persisted index along with a
+        digest of the unit's request fields, so that only the units whose
+        digest has changed since the previous hook need their requests to be
+        decoded again.  Which of them are pending is kept as well, along with
+        the digest of the certs published for the unit, and is only checked
+        against the published certs again once either digest changes.  So a
+        cert which is removed other than by being set again still makes its
+        request pending again.  Application requests share their SANs with
+        the other units, so they are always checked.
+        """
+        kv = unitdata.kv()
+        prefix = self.expand_name("{endpoint_name}.requests.")
+        stored = dict(self._stored_request_entries)
+        results = []
+        for unit in self.all_joined_units:
+            name = self._unit_entry_name(unit)
+            digest = self._request_digest(unit, REQUEST_FIELDS)
+            unit_name = CertificateRequest.resolve_unit_name(unit).replace("/", "_")
+            published = unit.relation.to_publish_raw["{}.digest".format(unit_name)]
+            entry = stored.pop(name, None)
+            if entry and entry["digest"] == digest:
+                requests = [
+                    self._request_from_args(unit, args) for args in entry["requests"]
+                ]
+            else:
+                requests = self._load_unit_requests(unit)
+                entry = {
+                    "digest": digest,
+                    "requests": [self._request_args(r) for r in requests],
+                }
+            if entry.get("published", "") == published and "pending" in entry:
+                pending = {tuple(key) for key in entry["pending"]}
+            else:
+                pending = {
+                    request._index_key
+                    for request in requests
+                    if request.cert_type != "application" and not request.is_handled
+                }
+                entry = dict(
+                    entry,
+                    published=published,
+                    pending=[list(key) for key in sorted(pending)],
+                )
+                kv.set(prefix + name, entry)
+            for request in requests:
+                if request.cert_type == "application":
+                    results.append((request, not request.is_handled))
+                else:
+                    results.append((request, request._index_key in pending))
+        for name in stored:
+            # the unit has departed
+            kv.unset(prefix + name)
+        return results
+
+    def _load_unit_requests(self, unit):
+        """
+        Build the requests from the data of a joined unit.
+        """
+        requests = []
+        # handle older single server cert request
+        if unit.received_raw["common_name"]:
+            requests.append(
+                CertificateRequest(
+                    unit,
+                    "server",
+                    unit.received_raw["certificate_name"],
+                    unit.received_raw["common_name"],
+                    unit.received["sans"],
+                    csr=unit.received["csr"],
+                    key_type=unit.received["key_type"],
+                    key_size=unit.received["key_size"],
+                    requested_at=unit.received["requested_at"],
+                    request_seq=unit.received["request_seq"],
+                )
+            )
+
+        # handle mutli server cert requests
+        reqs = unit.received["cert_requests"] or {}
+        for common_name, req in reqs.items():
+            requests.append(
+                CertificateRequest(
+                    unit,
+                    "server",
+                    common_name,
+                    common_name,
+                    req["sans"],
+                    csr=req.get("csr"),
+                    key_type=req.get("key_type"),
+                    key_size=req.get("key_size"),
+                    requested_at=req.get("requested_at"),
+                    request_seq=req.get("request_seq"),
+                )
+            )
+
+        # handle client cert requests
+        reqs = unit.received["client_cert_requests"] or {}
+        for common_name, req in reqs.items():
+            requests.append(
+                CertificateRequest(
+                    unit,
+                    "client",
+                    common_name,
+                    common_name,
+                    req["sans"],
+                    csr=req.get("csr"),
+                    key_type=req.get("key_type"),
+                    key_size=req.get("key_size"),
+                    requested_at=req.get("requested_at"),
+                    request_seq=req.get("request_seq"),
+                )
+            )
+        # handle application cert requests
+        reqs = unit.received["application_cert_requests"] or {}
+        for common_name, req in reqs.items():
+            requests.append(
+                ApplicationCertificateRequest(
+                    unit,
+                    "application",
+                    common_name,
+                    common_name,
+                    req["sans"],
+                    key_type=req.get("key_type"),
+                    key_size=req.get("key_size"),
+                    requested_at=req.get("requested_at"),
+                    request_seq=req.get("request_seq"),
+                )
+            )
+        # handle intermediate CA cert requests
+        reqs = unit.received["intermediate_cert_requests"] or {}
+        for common_name, req in reqs.items():
+            requests.append(
+                CertificateRequest(
+                    unit,
+                    "intermediate",
+                    common_name,
+                    common_name,
+                    req["sans"],
+                    key_type=req.get("key_type"),
+                    key_size=req.get("key_size"),
+                    requested_at=req.get("requested_at"),
+                    request_seq=req.get("request_seq"),
+                )
+            )
+        return requests
+
+    def _build_request_index(self):
+        """
+        Index all requests by relation ID, unit name, cert type and common name,
+        as well as the unhandled requests.  This is done once per hook, and the
+        index of unhandled requests is then kept up to date as they are handled.
+        """
+        if self._index is not None:
+            return
+        self._index, self._scopes, self._pending = {}, {}, {}
+        self._handled_at = time.time()
+        self._pending_types = Counter()
+        for request, pending in self._load_requests():
+            key = request._index_key
+            self._index[key] = request
+            if request.cert_type == "server":
+                self._scopes[request._key] = request
+            if pending:
+                self._pending[key] = request
+                self._pending_types[request.cert_type] += 1
+        if self._rotation_state:
+            # reissue the certs of the next wave of units with the new CA
+            done = set(self._rotation_state["done"])
+            wave = set(self._rotation_wave())
+            for key, request in self._index.items():
+                if key[:2] in wave and key not in self._pending:
+                    if "/".join(key) not in done:
+                        self._pending[key] = request
+                        self._pending_types[request.cert_type] += 1
+
+    @property
+    def _journal(self):
+        """
+        The issuance journal, which is kept apart from the unit's key-value
+        store so that each entry can be flushed as soon as it is written,
+        rather than only at the end of a successful hook.
+
+        It holds private keys, so the file is only readable by its owner.
+        """
+        if self._journal_db is None:
+            path = os.path.join(hookenv.charm_dir(), ".tls-issuance-journal.db")
+            # created without any access for others before anything is in it
+            fd = os.open(path, os.O_CREAT | os.O_WRONLY, 0o600)
+            try:
+                os.fchmod(fd, 0o600)
+            finally:
+                os.close(fd)
+            self._journal_db = unitdata.Storage(path)
+        return self._journal_db
+
+    @staticmethod
+    def _cert_fingerprint(request):
+        cert = request.cert
+        if cert is None:
+            return None
+        return hashlib.sha256(cert.cert.encode()).hexdigest()
+
+    def _journal_issued(self, request):
+        """
+        Record the cert just set for a request in the issuance journal.
+        """
+        cert = request.cert
+        if cert is None:
+            return
+        self._journal.set(
+            self.expand_name("{endpoint_name}.journal.") + "/".join(request._index_key),
+            {
+                "request": request._fingerprint,
+                "cert_fingerprint": self._cert_fingerprint(request),
+                "cert": cert.cert,
+                "key": cert.key,
+                "status": "signed",
+            },
+        )
+        self._journal.flush()
+
+    def _replay_journal(self):
+        """
+        Publish the certs in the issuance journal which were lost with a
+        failed hook, and mark those which made it as published.
+
+        Entries for requests which have since changed or gone are dropped.
+        This is done once per hook, before the requests are handed out.
+        """
+        self._build_request_index()
+        journal = self._journal
+        prefix = self.expand_name("{endpoint_name}.journal.")
+        keys = {"/".join(key): key for key in self._index}
+        replay = []
+        for name, entry in journal.getrange(prefix, strip=True).items():
+            request = self._index.get(keys.get(name))
+            if request is None or entry["request"] != request._fingerprint:
+                journal.unset(prefix + name)
+            elif entry["status"] != "signed":
+                continue
+            elif self._cert_fingerprint(request) == entry["cert_fingerprint"]:
+                # the cert and key are in the relation data now
+                published = dict(entry, status="published")
+                del published["cert"], published["key"]
+                journal.set(prefix + name, published)
+            elif request._index_key not in self._pending:
+                # superseded by another cert since
+                journal.unset(prefix + name)
+            else:
+                replay.append((request, entry))
+        # not timed, since these certs have already been issued
+        self._handled_at = None
+        for request, entry in replay:
+            # the other requests for an application cert are handled with it
+            if request._index_key in self._pending:
+                request.set_cert(entry["cert"], entry["key"])
+        self._handled_at = time.time()
+        journal.flush()
+        if replay:
+            hookenv.log("Published {} certs from the journal".format(len(replay)))
+
+    @property
+    def _pending_requests(self):
+        self._build_request_index()
+        return self._pending
+
+    def _request_handled(self, request):
+        """
+        Remove a request from the index of unhandled requests, and clear the
+        requested flags once there are no more requests of its type.
+        """
+        pending = self._pending_requests
+        self._journal_issued(request)
+        if request._index_key in pending and self._handled_at is not None:
+            # moving average of the time taken to handle each request
+            now, kv = time.time(), unitdata.kv()
+            key = self.expand_name("{endpoint_name}.request-time")
+            average, elapsed = kv.get(key), now - self._handled_at
+            if average is None:
+                average = elapsed
+            else:
+                average = 0.8 * average + 0.2 * elapsed
+            kv.set(key, average)
+            self._handled_at = now
+        keys = [request._index_key]
+        if request.cert_type == "application":
+            # a single cert is shared by all units of the application
+            relation_id = request._unit.relation.relation_id
+            keys.extend(
+                key
+                for key, req in pending.items()
+                if key[0] == relation_id and req.cert_type == "application"
+            )
+        for key in keys:
+            if pending.pop(key, None) is not None:
+                self._pending_types[request.cert_type] -= 1
+        if self._rotation_state:
+            # these certs have been reissued with the new CA
+            self._rotation_state["done"].extend("/".join(key) for key in keys)
+            key = self.expand_name("{endpoint_name}.ca-rotation")
+            unitdata.kv().set(key, self._rotation_state)
+        if not self._pending_types[request.cert_type]:
+            prefix = self.expand_name("{endpoint_name}." + request.cert_type)
+            clear_flag(prefix + ".certs.requested")
+            if request.cert_type in ("server", "client"):
+                clear_flag(prefix + ".cert.requested")
+        if not pending:
+            clear_flag(self.expand_name("{endpoint_name}.certs.requested"))
+
     @property
     def all_requests(self):
         """
@@ -173,54 +994,8 @@ class TlsProvides(Endpoint):
                 request.set_cert(cert, key)
         ```
         """
-        requests = []
-        for unit in self.all_joined_units:
-            # handle older single server cert request
-            if unit.received_raw["common_name"]:
-                requests.append(
-                    CertificateRequest(
-                        unit,
-                        "server",
-                        unit.received_raw["certificate_name"],
-                        unit.received_raw["common_name"],
-                        unit.received["sans"],
-                    )
-                )
-
-            # handle mutli server cert requests
-            reqs = unit.received["cert_requests"] or {}
-            for common_name, req in reqs.items():
-                requests.append(
-                    CertificateRequest(
-                        unit, "server", common_name, common_name, req["sans"]
-                    )
-                )
-
-            # handle client cert requests
-            reqs = unit.received["client_cert_requests"] or {}
-            for common_name, req in reqs.items():
-                requests.append(
-                    CertificateRequest(
-                        unit, "client", common_name, common_name, req["sans"]
-                    )
-                )
-            # handle application cert requests
-            reqs = unit.received["application_cert_requests"] or {}
-            for common_name, req in reqs.items():
-                requests.append(
-                    ApplicationCertificateRequest(
-                        unit, "application", common_name, common_name, req["sans"]
-                    )
-                )
-            # handle intermediate CA cert requests
-            reqs = unit.received["intermediate_cert_requests"] or {}
-            for common_name, req in reqs.items():
-                requests.append(
-                    CertificateRequest(
-                        unit, "intermediate", common_name, common_name, req["sans"]
-                    )
-                )
-        return requests
+        self._build_request_index()
+        return list(self._index.values())
 
     @property
     def new_requests(self):
@@ -246,7 +1021,43 @@ class TlsProvides(Endpoint):
                 request.set_cert(cert, key)
         ```
         """
-        return [req for req in self.all_requests if not req.is_handled]
+        return list(self._pending_requests.values())
+
+    @property
+    def new_csr_requests(self):
+        """
+        Filtered view of [new_requests][] that only includes requests which
+        carry a certificate signing request, for which the requirer generated
+        its own private key.  Only the signed cert should be published for these.
+
+        Each will be an instance of [CertificateRequest][].
+
+        Example usage:
+
+        ```python
+        @when('tls.certs.requested')
+        def sign_csrs():
+            tls = endpoint_from_flag('tls.certs.requested')
+            for request in tls.new_csr_requests:
+                cert = sign_csr(request.cert_type, request.csr)
+                request.set_cert(cert)
+        ```
+        """
+        return [req for req in self._pending_requests.values() if req.csr]
+
+    @property
+    def queue_ages(self):
+        """
+        List of `(request, seconds)` pairs for the [new_requests][] which were
+        stamped by the requirer, with how long each has been waiting, oldest
+        first.
+        """
+        ages = [
+            (req, req.queue_age)
+            for req in self._pending_requests.values()
+            if req.queue_age is not None
+        ]
+        return sorted(ages, key=lambda item: item[1], reverse=True)
 
     @property
     def new_server_requests(self):
@@ -268,7 +1079,9 @@ class TlsProvides(Endpoint):
                 request.set_cert(cert, key)
         ```
         """
-        return [req for req in self.new_requests if req.cert_type == "server"]
+        return [
+            req for req in self._pending_requests.values() if req.cert_type == "server"
+        ]
 
     @property
     def new_client_requests(self):
@@ -290,7 +1103,9 @@ class TlsProvides(Endpoint):
                 request.set_cert(cert, key)
         ```
         """
-        return [req for req in self.new_requests if req.cert_type == "client"]
+        return [
+            req for req in self._pending_requests.values() if req.cert_type == "client"
+        ]
 
     @property
     def new_application_requests(self):
@@ -315,7 +1130,11 @@ class TlsProvides(Endpoint):
         :returns: List of certificate requests.
         :rtype: [CertificateRequest, ]
         """
-        return [req for req in self.new_requests if req.cert_type == "application"]
+        return [
+            req
+            for req in self._pending_requests.values()
+            if req.cert_type == "application"
+        ]
 
     @property
     def new_intermediate_requests(self):
@@ -337,7 +1156,11 @@ class TlsProvides(Endpoint):
                 request.set_cert(cert, key)
         ```
         """
-        return [req for req in self.new_requests if req.cert_type == "intermediate"]
+        return [
+            req
+            for req in self._pending_requests.values()
+            if req.cert_type == "intermediate"
+        ]
 
     @property
     def all_published_certs(self):
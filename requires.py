@@ -4,16 +4,28 @@ if not __package__:
 
     __package__ = sys.modules[""].__name__
 
+import hashlib
+import time
 import uuid
 
-from charmhelpers.core import hookenv
+from charmhelpers.core import hookenv, unitdata
 
 from charms.reactive import when, when_not
-from charms.reactive import set_flag, clear_flag, toggle_flag
+from charms.reactive import set_flag, clear_flag, toggle_flag, is_flag_set
 from charms.reactive import Endpoint
 from charms.reactive import data_changed
 
-from .tls_certificates_common import Certificate
+from .tls_certificates_common import (
+    Certificate,
+    CertificateChanges,
+    cert_matches_key,
+    generate_csr,
+    generate_private_key,
+    key_options,
+    record_latency,
+    stamp_request,
+    STAMP_FIELDS,
+)
 
 
 class TlsRequires(Endpoint):
@@ -60,6 +72,30 @@ class TlsRequires(Endpoint):
         they have just become available or if they were regenerated by the CA.
         Once processed this flag should be removed by the charm.
 
+    When one of the `changed` flags is set, the [changed_server_certs][],
+    [changed_client_certs][] and `changed_intermediate_certs` collections
+    describe exactly which certificates were added, modified or removed, so
+    that only the affected files and services need to be updated.  The
+    [write_certs][] helper can be used to write them to disk.
+
+    By default, all requests are sent to the first related CA.  If the
+    `{endpoint_name}.fan-out` flag is set with [set_fan_out][], requests are
+    instead spread across all related CAs by hashing their common name, and
+    the certs and CA certificates received from each of them are aggregated
+    into a single view.
+
+    By default, the CA generates the private key for each certificate and
+    sends it back over the relation.  If the `{endpoint_name}.csr-mode` flag is
+    set with [set_csr_mode][], server and client cert requests instead carry a
+    certificate signing request for a private key which is generated and kept
+    locally, and only the signed cert is sent back by the CA.  This requires
+    the `cryptography` package to be available to the charm.
+
+    Each request is stamped with the time it was made and a sequence number,
+    which are kept until the request changes.  The time from each request
+    until its cert first appears is recorded in the [issuance_latency][]
+    histograms.
+
     The following flags have been deprecated:
 
       * `{endpoint_name}.server.cert.available`
@@ -75,14 +111,46 @@ class TlsRequires(Endpoint):
     [server_certs]: requires.md#requires.TlsRequires.server_certs
     [server_certs_map]: requires.md#requires.TlsRequires.server_certs_map
     [client_certs]: requires.md#requires.TlsRequires.server_certs
+    [CertificateChanges]: common.md#tls_certificates_common.CertificateChanges
+    [write_certs]: common.md#tls_certificates_common.write_certs
+    [changed_server_certs]: requires.md#requires.TlsRequires.changed_server_certs
+    [changed_client_certs]: requires.md#requires.TlsRequires.changed_client_certs
+    [set_fan_out]: requires.md#requires.TlsRequires.set_fan_out
+    [set_csr_mode]: requires.md#requires.TlsRequires.set_csr_mode
+    [issuance_latency]: requires.md#requires.TlsRequires.issuance_latency
     """
 
+    def __init__(self, endpoint_name, relation_ids=None):
+        super().__init__(endpoint_name, relation_ids)
+        self._received = None
+
     @when("endpoint.{endpoint_name}.joined")
     def joined(self):
-        self.relations[0].to_publish_raw["unit_name"] = self._unit_name
+        for relation in self.relations:
+            relation.to_publish_raw["unit_name"] = self._unit_name
         prefix = self.expand_name("{endpoint_name}.")
         ca_available = self.root_ca_cert
-        ca_changed = ca_available and data_changed(prefix + "ca", self.root_ca_cert)
+        ca_changed = ca_available and data_changed(prefix + "ca", self.root_ca_bundle)
+        set_flag(prefix + "available")
+        toggle_flag(prefix + "ca.available", ca_available)
+        toggle_flag(prefix + "ca.changed", ca_changed)
+
+        kv = unitdata.kv()
+        digest = self._certs_digest
+        unchanged = digest is not None and kv.get(prefix + "digest") == digest
+        if unchanged and is_flag_set(prefix + "certs.available"):
+            # the CAs say that none of this unit's certs have changed, so
+            # there is no need to decode and compare them again; but only
+            # while the flags still reflect those certs
+            for name in ("servers", "clients", "intermediates"):
+                kv.set(prefix + "changes." + name, CertificateChanges().names)
+            clear_flag(prefix + "server.certs.changed")
+            clear_flag(prefix + "client.certs.changed")
+            clear_flag(prefix + "intermediate.certs.changed")
+            clear_flag(prefix + "certs.changed")
+            return
+        kv.set(prefix + "digest", digest)
+
         server_available = self.server_certs
         server_changed = server_available and data_changed(
             prefix + "servers", self.server_certs
@@ -97,10 +165,11 @@ class TlsRequires(Endpoint):
         )
         certs_available = server_available or client_available or intermediate_available
         certs_changed = server_changed or client_changed or intermediate_changed
+        self._record_cert_changes("servers", self.server_certs_map)
+        self._record_cert_changes("clients", self.client_certs_map)
+        self._record_cert_changes("intermediates", self.intermediate_certs_map)
+        self._record_issuance_latency()
 
-        set_flag(prefix + "available")
-        toggle_flag(prefix + "ca.available", ca_available)
-        toggle_flag(prefix + "ca.changed", ca_changed)
         toggle_flag(prefix + "server.certs.available", server_available)
         toggle_flag(prefix + "server.certs.changed", server_changed)
         toggle_flag(prefix + "client.certs.available", client_available)
@@ -132,11 +201,307 @@ class TlsRequires(Endpoint):
         clear_flag(prefix + "server.cert.available")
         clear_flag(prefix + "client.cert.available")
         clear_flag(prefix + "batch.cert.available")
+        kv = unitdata.kv()
+        for name in ("servers", "clients", "intermediates"):
+            kv.unset(prefix + "fingerprints." + name)
+            kv.unset(prefix + "changes." + name)
+        kv.unset(prefix + "digest")
 
     @property
     def _unit_name(self):
         return hookenv.local_unit().replace("/", "_")
 
+    @property
+    def fan_out(self):
+        """
+        Whether requests are spread across all related CAs.
+        """
+        return is_flag_set(self.expand_name("{endpoint_name}.fan-out"))
+
+    def set_fan_out(self, enabled=True):
+        """
+        Enable or disable spreading requests across all related CAs.
+
+        This should be set before any certificates are requested, since
+        changing it can move existing requests to a different CA.
+        """
+        toggle_flag(self.expand_name("{endpoint_name}.fan-out"), enabled)
+
+    @property
+    def csr_mode(self):
+        """
+        Whether server and client certs are requested with a locally generated
+        private key and certificate signing request.
+        """
+        return is_flag_set(self.expand_name("{endpoint_name}.csr-mode"))
+
+    def set_csr_mode(self, enabled=True):
+        """
+        Enable or disable requesting server and client certs with a locally
+        generated private key and certificate signing request.
+        """
+        toggle_flag(self.expand_name("{endpoint_name}.csr-mode"), enabled)
+
+    def _csr_key(self, cert_type, cn):
+        return self.expand_name("{endpoint_name}.csr.") + cert_type + "." + cn
+
+    def _csr_for(self, cert_type, cn, sans, options):
+        """
+        Return the CSR for a request, generating the private key the first time
+        the cert is requested or the key options change, and a new CSR whenever
+        the `sans` change.  The previous key is kept until a cert for the new
+        one arrives.
+        """
+        kv = unitdata.kv()
+        sans = sorted(set(sans or []))
+        stored = kv.get(self._csr_key(cert_type, cn)) or {}
+        if not stored.get("key") or stored.get("key_options") != options:
+            previous_key = stored.get("previous_key") or stored.get("key")
+            stored = {
+                "key": generate_private_key(**dict({"key_type": "rsa"}, **options)),
+                "key_options": options,
+            }
+            if previous_key:
+                stored["previous_key"] = previous_key
+        if not stored.get("csr") or stored.get("sans") != sans:
+            stored["csr"] = generate_csr(stored["key"], cn, sans)
+            stored["sans"] = sans
+            kv.set(self._csr_key(cert_type, cn), stored)
+        return stored["csr"]
+
+    def _certificate(self, cert_type, cn, cert, key):
+        """
+        Build the [Certificate][] for a cert received from the CA, using the
+        locally generated private key if the CA didn't send one.  While the
+        key is being replaced, only the key which the cert was issued for is
+        used, and the previous key is dropped once the cert for the new key
+        has arrived.
+        """
+        if not key:
+            kv = unitdata.kv()
+            stored = kv.get(self._csr_key(cert_type, cn)) or {}
+            key, previous_key = stored.get("key"), stored.get("previous_key")
+            if previous_key and cert:
+                if key and cert_matches_key(cert, key):
+                    del stored["previous_key"]
+                    kv.set(self._csr_key(cert_type, cn), stored)
+                elif cert_matches_key(cert, previous_key):
+                    key = previous_key
+                else:
+                    key = None
+        return Certificate(cert_type, cn, cert, key)
+
+    def _relation_for(self, cn):
+        """
+        Select the relation which a request for `cn` should be sent to.
+
+        With fan-out enabled, this uses rendezvous hashing of the remote
+        application and common name, so that only the requests of a single
+        CA are moved when another CA is related or removed.
+        """
+        if not self.relations:
+            return None
+        if not self.fan_out:
+            # assume we'll only be connected to one provider
+            return self.relations[0]
+
+        def weight(relation):
+            name = relation.application_name or relation.relation_id
+            return hashlib.sha256("{}:{}".format(name, cn).encode("utf8")).digest()
+
+        return max(self.relations, key=weight)
+
+    def _drop_request(self, cn, field, keep=None):
+        """
+        Remove the request for `cn` from `field` on every relation but `keep`,
+        if given.
+        """
+        for relation in self.relations:
+            if relation is keep:
+                continue
+            to_publish_raw = relation.to_publish_raw
+            if field == "cert_requests" and to_publish_raw["common_name"] == cn:
+                # the first server cert request is in its own fields
+                for key in (
+                    "common_name",
+                    "sans",
+                    "certificate_name",
+                    "csr",
+                    "key_type",
+                    "key_size",
+                ) + STAMP_FIELDS:
+                    to_publish_raw[key] = None
+            requests = relation.to_publish.get(field)
+            if requests and cn in requests:
+                del requests[cn]
+                if requests:
+                    relation.to_publish[field] = requests
+                else:
+                    to_publish_raw[field] = None
+
+    @property
+    def _provider_data(self):
+        """
+        The data received from all related CAs, read in a single pass.
+        """
+        if self._received is None:
+            received = {"ca": [], "chain": [], "server": [], "queue_status": []}
+            for relation in self.relations:
+                units = relation.joined_units
+                for field in ("ca", "chain"):
+                    value = units.received_raw[field]
+                    if value and value not in received[field]:
+                        received[field].append(value)
+                cert = units.received_raw["{}.server.cert".format(self._unit_name)]
+                key = units.received_raw["{}.server.key".format(self._unit_name)]
+                if cert:
+                    received["server"].append((relation, cert, key))
+                if units.received["queue_status"]:
+                    received["queue_status"].append(units.received["queue_status"])
+                for field in (
+                    "processed_requests",
+                    "processed_client_requests",
+                    "processed_application_requests",
+                    "processed_intermediate_requests",
+                ):
+                    certs_data = received.setdefault(field, {})
+                    value = units.received["{}.{}".format(self._unit_name, field)]
+                    certs_data.update(value or {})
+            self._received = received
+        return self._received
+
+    @property
+    def _certs_digest(self):
+        """
+        The digests published by the related CAs of this unit's certs, or
+        None unless every one of them publishes it.
+        """
+        digests = [
+            relation.joined_units.received_raw["{}.digest".format(self._unit_name)]
+            for relation in self.relations
+        ]
+        if not digests or None in digests:
+            return None
+        return ",".join(digests)
+
+    def _record_cert_changes(self, name, certs_map):
+        """
+        Compare the given certs against the fingerprints seen by the previous
+        hook, and store the resulting changes for the rest of this hook.
+        """
+        kv = unitdata.kv()
+        prefix = self.expand_name("{endpoint_name}.")
+        fingerprints = kv.get(prefix + "fingerprints." + name) or {}
+        changes = CertificateChanges.from_fingerprints(fingerprints, certs_map)
+        kv.set(
+            prefix + "fingerprints." + name,
+            {cn: cert.fingerprint for cn, cert in certs_map.items()},
+        )
+        kv.set(prefix + "changes." + name, changes.names)
+        return changes
+
+    def _cert_changes(self, name, certs_map):
+        prefix = self.expand_name("{endpoint_name}.")
+        names = unitdata.kv().get(prefix + "changes." + name)
+        return CertificateChanges.from_names(names, certs_map)
+
+    def _next_request_seq(self):
+        kv = unitdata.kv()
+        key = self.expand_name("{endpoint_name}.request-seq")
+        seq = (kv.get(key) or 0) + 1
+        kv.set(key, seq)
+        return seq
+
+    def _stamped_requests(self):
+        """
+        Yield the cert type, common name and stamp of each request made.
+        """
+        fields = {
+            "server": "cert_requests",
+            "client": "client_cert_requests",
+            "application": "application_cert_requests",
+            "intermediate": "intermediate_cert_requests",
+        }
+        for relation in self.relations:
+            to_publish = relation.to_publish
+            if to_publish.get("request_seq") is not None:
+                # the first server cert request is in its own fields
+                cn = relation.to_publish_raw["common_name"]
+                yield "server", cn, to_publish
+            for cert_type, field in fields.items():
+                for cn, request in (to_publish.get(field) or {}).items():
+                    if request.get("request_seq") is not None:
+                        yield cert_type, cn, request
+
+    def _record_issuance_latency(self):
+        """
+        Record the latency of each request whose cert has appeared since it
+        was made.
+        """
+        kv = unitdata.kv()
+        prefix = self.expand_name("{endpoint_name}.")
+        issued = kv.get(prefix + "issued") or {}
+        histograms = kv.get(prefix + "latency") or {}
+        certs_maps = {
+            "server": self.server_certs_map,
+            "client": self.client_certs_map,
+            "application": {c.common_name: c for c in self.application_certs},
+            "intermediate": self.intermediate_certs_map,
+        }
+        now = time.time()
+        for cert_type, cn, stamp in self._stamped_requests():
+            certs_map = certs_maps[cert_type]
+            # a single cert is shared by all application requests
+            cert = certs_map.get(cn) or certs_map.get("app_data")
+            seen = issued.get(cert_type + "." + cn) or {}
+            if (
+                cert is None
+                or seen.get("seq") == stamp["request_seq"]
+                or seen.get("fingerprint") == cert.fingerprint
+            ):
+                continue
+            issued[cert_type + "." + cn] = {
+                "seq": stamp["request_seq"],
+                "fingerprint": cert.fingerprint,
+            }
+            histogram = histograms.setdefault(cert_type, {})
+            record_latency(histogram, now - stamp["requested_at"])
+        kv.set(prefix + "issued", issued)
+        kv.set(prefix + "latency", histograms)
+
+    @property
+    def issuance_latency(self):
+        """
+        Histograms of the time from each request until its cert first
+        appeared, by cert type.
+
+        Each histogram is a dict with the `count` and `sum` of the latencies in
+        seconds, and the count of latencies in each bucket of `buckets`, keyed
+        by the bucket's upper bound in seconds, or '+Inf'.
+        """
+        return unitdata.kv().get(self.expand_name("{endpoint_name}.latency")) or {}
+
+    @property
+    def queue_status(self):
+        """
+        How busy the related CAs are, or None if they don't say.
+
+        This is a dict with the number of requests `pending` across all of the
+        related CAs, and an estimate of the seconds until they are handled as
+        `retry_after`, or None if there is no estimate yet.  Requests made
+        while the CAs are busy will wait behind those already pending.
+        """
+        statuses = self._provider_data["queue_status"]
+        if not statuses:
+            return None
+        estimates = [
+            s["retry_after"] for s in statuses if s.get("retry_after") is not None
+        ]
+        return {
+            "pending": sum(s.get("pending", 0) for s in statuses),
+            "retry_after": max(estimates) if estimates else None,
+        }
+
     @property
     def root_ca_cert(self):
         """
@@ -144,7 +509,18 @@ class TlsRequires(Endpoint):
         """
         # only the leader of the provider should set the CA, or all units
         # had better agree
-        return self.all_joined_units.received_raw["ca"]
+        cas = self._provider_data["ca"]
+        return cas[0] if cas else None
+
+    @property
+    def root_ca_bundle(self):
+        """
+        All of the distinct root CA certificates from every related CA.
+
+        This is the same as [root_ca_cert][] unless fan-out is enabled.
+        """
+        cas = self._provider_data["ca"]
+        return "\n".join(cas) if cas else None
 
     def get_ca(self):
         """
@@ -161,7 +537,8 @@ class TlsRequires(Endpoint):
         """
         # only the leader of the provider should set the CA, or all units
         # had better agree
-        return self.all_joined_units.received_raw["chain"]
+        chains = self._provider_data["chain"]
+        return chains[0] if chains else None
 
     def get_chain(self):
         """
@@ -198,24 +575,20 @@ class TlsRequires(Endpoint):
         List of [Certificate][] instances for all available server certs.
         """
         certs = []
-        raw_data = self.all_joined_units.received_raw
-        json_data = self.all_joined_units.received
 
         # for backwards compatibility, the first cert goes in its own fields
-        if self.relations:
-            common_name = self.relations[0].to_publish_raw["common_name"]
-            cert = raw_data["{}.server.cert".format(self._unit_name)]
-            key = raw_data["{}.server.key".format(self._unit_name)]
-            if cert and key:
-                certs.append(Certificate("server", common_name, cert, key))
+        for relation, cert, key in self._provider_data["server"]:
+            common_name = relation.to_publish_raw["common_name"]
+            certs.append(self._certificate("server", common_name, cert, key))
 
         # subsequent requests go in the collection
-        field = "{}.processed_requests".format(self._unit_name)
-        certs_data = json_data[field] or {}
+        certs_data = self._provider_data["processed_requests"]
         certs.extend(
-            Certificate("server", common_name, cert["cert"], cert["key"])
+            self._certificate("server", common_name, cert["cert"], cert.get("key"))
             for common_name, cert in certs_data.items()
         )
+        # without a key, the cert is of no use
+        certs = [cert for cert in certs if cert.key]
         return certs
 
     @property
@@ -227,9 +600,7 @@ class TlsRequires(Endpoint):
         :rtype: [Certificate()]
         """
         certs = []
-        json_data = self.all_joined_units.received
-        field = "{}.processed_application_requests".format(self._unit_name)
-        certs_data = json_data[field] or {}
+        certs_data = self._provider_data["processed_application_requests"]
         app_cert_data = certs_data.get("app_data")
         if app_cert_data:
             certs = [
@@ -246,6 +617,15 @@ class TlsRequires(Endpoint):
         """
         return {cert.common_name: cert for cert in self.server_certs}
 
+    @property
+    def changed_server_certs(self):
+        """
+        [CertificateChanges][] of the server certs since the previous hook,
+        with the added and modified [Certificate][] instances keyed by their
+        `common_name`.
+        """
+        return self._cert_changes("servers", self.server_certs_map)
+
     def get_batch_requests(self):
         """
         Deprecated.  Use [server_certs_map][] instead.
@@ -259,12 +639,13 @@ class TlsRequires(Endpoint):
         """
         List of [Certificate][] instances for all available client certs.
         """
-        field = "{}.processed_client_requests".format(self._unit_name)
-        certs_data = self.all_joined_units.received[field] or {}
-        return [
-            Certificate("client", common_name, cert["cert"], cert["key"])
+        certs_data = self._provider_data["processed_client_requests"]
+        certs = [
+            self._certificate("client", common_name, cert["cert"], cert.get("key"))
             for common_name, cert in certs_data.items()
         ]
+        # without a key, the cert is of no use
+        return [cert for cert in certs if cert.key]
 
     @property
     def client_certs_map(self):
@@ -273,15 +654,22 @@ class TlsRequires(Endpoint):
         """
         return {cert.common_name: cert for cert in self.client_certs}
 
+    @property
+    def changed_client_certs(self):
+        """
+        [CertificateChanges][] of the client certs since the previous hook,
+        with the added and modified [Certificate][] instances keyed by their
+        `common_name`.
+        """
+        return self._cert_changes("clients", self.client_certs_map)
+
     @property
     def intermediate_certs(self):
         """
         List of [Certificate][] instances for all available intermediate CA certs.
         """
         certs = []
-        json_data = self.all_joined_units.received
-        field = "{}.processed_intermediate_requests".format(self._unit_name)
-        certs_data = json_data[field] or {}
+        certs_data = self._provider_data["processed_intermediate_requests"]
         app_cert_data = certs_data.get("app_data")
         if app_cert_data:
             certs = [
@@ -301,34 +689,73 @@ class TlsRequires(Endpoint):
         """
         return {cert.common_name: cert for cert in self.intermediate_certs}
 
-    def request_server_cert(self, cn, sans=None, cert_name=None):
+    @property
+    def changed_intermediate_certs(self):
+        """
+        [CertificateChanges][] of the intermediate CA certs since the previous
+        hook, with the added and modified [Certificate][] instances keyed by
+        their `common_name`.
+        """
+        return self._cert_changes("intermediates", self.intermediate_certs_map)
+
+    def request_server_cert(
+        self, cn, sans=None, cert_name=None, key_type=None, key_size=None
+    ):
         """
         Request a server certificate and key be generated for the given
         common name (`cn`) and optional list of alternative names (`sans`).
 
         The `cert_name` is deprecated and not needed.
 
+        The optional `key_type`, one of 'rsa', 'ecdsa' or 'ed25519', and
+        `key_size` tell the CA which kind of private key to generate.  ECDSA
+        keys are much faster to generate and smaller than RSA keys.
+
         This can be called multiple times to request more than one server
         certificate, although the common names must be unique.  If called
         again with the same common name, it will be ignored.
         """
-        if not self.relations:
+        relation = self._relation_for(cn)
+        if not relation:
             return
-        # assume we'll only be connected to one provider
-        to_publish_json = self.relations[0].to_publish
-        to_publish_raw = self.relations[0].to_publish_raw
+        if self.fan_out:
+            self._drop_request(cn, "cert_requests", keep=relation)
+        to_publish_json = relation.to_publish
+        to_publish_raw = relation.to_publish_raw
+        options = key_options(key_type, key_size)
+        if self.csr_mode:
+            options["csr"] = self._csr_for("server", cn, sans, dict(options))
         if to_publish_raw["common_name"] in (None, "", cn):
             # for backwards compatibility, first request goes in its own fields
+            fields = ("sans", "csr", "key_type", "key_size") + STAMP_FIELDS
+            previous = {
+                field: to_publish_json[field]
+                for field in fields
+                if to_publish_json[field] is not None
+            }
+            if to_publish_raw["common_name"] != cn:
+                previous = None
+            request = stamp_request(
+                dict(options, sans=sans or []), previous, self._next_request_seq
+            )
             to_publish_raw["common_name"] = cn
-            to_publish_json["sans"] = sans or []
             cert_name = to_publish_raw.get("certificate_name") or cert_name
             if cert_name is None:
                 cert_name = str(uuid.uuid4())
             to_publish_raw["certificate_name"] = cert_name
+            for field in fields:
+                if field in request:
+                    to_publish_json[field] = request[field]
+                else:
+                    to_publish_raw[field] = None
         else:
             # subsequent requests go in the collection
             requests = to_publish_json.get("cert_requests", {})
-            requests[cn] = {"sans": sans or []}
+            requests[cn] = stamp_request(
+                dict(options, sans=sans or []),
+                requests.get(cn),
+                self._next_request_seq,
+            )
             to_publish_json["cert_requests"] = requests
 
     def add_request_server_cert(self, cn, sans):
@@ -343,50 +770,101 @@ class TlsRequires(Endpoint):
         """
         pass
 
-    def request_client_cert(self, cn, sans):
+    def request_client_cert(self, cn, sans, key_type=None, key_size=None):
         """
         Request a client certificate and key be generated for the given
-        common name (`cn`) and list of alternative names (`sans`).
+        common name (`cn`) and list of alternative names (`sans`), and
+        optionally the `key_type` and `key_size` as for [request_server_cert][].
 
         This can be called multiple times to request more than one client
         certificate, although the common names must be unique.  If called
         again with the same common name, it will be ignored.
         """
-        if not self.relations:
+        relation = self._relation_for(cn)
+        if not relation:
             return
-        # assume we'll only be connected to one provider
-        to_publish_json = self.relations[0].to_publish
+        if self.fan_out:
+            self._drop_request(cn, "client_cert_requests", keep=relation)
+        to_publish_json = relation.to_publish
+        options = key_options(key_type, key_size)
+        if self.csr_mode:
+            options["csr"] = self._csr_for("client", cn, sans, dict(options))
         requests = to_publish_json.get("client_cert_requests", {})
-        requests[cn] = {"sans": sans}
+        requests[cn] = stamp_request(
+            dict(options, sans=sans), requests.get(cn), self._next_request_seq
+        )
         to_publish_json["client_cert_requests"] = requests
 
-    def request_application_cert(self, cn, sans):
+    def request_application_cert(self, cn, sans, key_type=None, key_size=None):
         """
         Request an application certificate and key be generated for the given
         common name (`cn`) and list of alternative names (`sans` ) of this
         unit and all peer units. All units will share a single certificates.
+
+        The `key_type` and `key_size` are optional, as for [request_server_cert][].
         """
-        if not self.relations:
+        # all units of this application must use the same CA
+        relation = self._relation_for(hookenv.local_unit().split("/")[0])
+        if not relation:
             return
-        # assume we'll only be connected to one provider
-        to_publish_json = self.relations[0].to_publish
+        if self.fan_out:
+            self._drop_request(cn, "application_cert_requests", keep=relation)
+        to_publish_json = relation.to_publish
         requests = to_publish_json.get("application_cert_requests", {})
-        requests[cn] = {"sans": sans}
+        requests[cn] = stamp_request(
+            dict(key_options(key_type, key_size), sans=sans),
+            requests.get(cn),
+            self._next_request_seq,
+        )
         to_publish_json["application_cert_requests"] = requests
 
-    def request_intermediate_cert(self, cn, sans):
+    def request_intermediate_cert(self, cn, sans, key_type=None, key_size=None):
         """
         Request an intermediate CA certificate and key be generated for the given
-        common name (`cn`) and list of alternative names (`sans`).
+        common name (`cn`) and list of alternative names (`sans`), and
+        optionally the `key_type` and `key_size` as for [request_server_cert][].
 
         This can be called multiple times to request more than one client
         certificate, although the common names must be unique.  If called
         again with the same common name, it will be ignored.
         """
-        if not self.relations:
+        relation = self._relation_for(cn)
+        if not relation:
             return
-        # assume we'll only be connected to one provider
-        to_publish_json = self.relations[0].to_publish
+        if self.fan_out:
+            self._drop_request(cn, "intermediate_cert_requests", keep=relation)
+        to_publish_json = relation.to_publish
         requests = to_publish_json.get("intermediate_cert_requests", {})
-        requests[cn] = {"sans": sans or []}
+        requests[cn] = stamp_request(
+            dict(key_options(key_type, key_size), sans=sans or []),
+            requests.get(cn),
+            self._next_request_seq,
+        )
         to_publish_json["intermediate_cert_requests"] = requests
+
+    def withdraw_cert(self, cn, cert_type=None):
+        """
+        Withdraw the request for the given common name (`cn`), so that the CA
+        will stop publishing its certificate.
+
+        If `cert_type` is given, as one of 'server', 'client', 'application'
+        or 'intermediate', only that type of request is withdrawn.  Otherwise,
+        requests of every type with that common name are withdrawn.
+        """
+        fields = {
+            "server": "cert_requests",
+            "client": "client_cert_requests",
+            "application": "application_cert_requests",
+            "intermediate": "intermediate_cert_requests",
+        }
+        if cert_type is not None and cert_type not in fields:
+            raise ValueError("Unknown cert_type: {}".format(cert_type))
+        kv = unitdata.kv()
+        issued_key = self.expand_name("{endpoint_name}.issued")
+        issued = kv.get(issued_key) or {}
+        for request_type, field in fields.items():
+            if cert_type in (None, request_type):
+                self._drop_request(cn, field)
+                kv.unset(self._csr_key(request_type, cn))
+                issued.pop(request_type + "." + cn, None)
+        kv.set(issued_key, issued)
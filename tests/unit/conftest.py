@@ -0,0 +1,146 @@
+import datetime
+import sys
+import types
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from charmhelpers.core import hookenv, unitdata
+from charms.reactive import Endpoint
+
+# the interface layer is imported as a package named after its directory
+# once it is built into a charm, so make it importable as one here
+layer = types.ModuleType("tls_certificates")
+layer.__path__ = [str(Path(__file__).parents[2])]
+sys.modules.setdefault("tls_certificates", layer)
+
+# the endpoints are registered against the charm's metadata on import
+with mock.patch("charmhelpers.core.hookenv.metadata") as metadata:
+    metadata.return_value = {
+        "requires": {"certificates": {"interface": "tls-certificates"}},
+        "provides": {"certificates": {"interface": "tls-certificates"}},
+    }
+    import tls_certificates.provides  # noqa: F401
+    import tls_certificates.requires  # noqa: F401
+
+
+class Juju:
+    """
+    A single relation between a CA and the units of a requirer, with all of
+    its data kept in memory, which hooks are run against as either side.
+    """
+
+    relation_id = "certificates:1"
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.data = {"easyrsa/0": {}}
+        self.local = "easyrsa/0"
+        self.hook_name = "certificates-relation-changed"
+        self.remote_unit = None
+        self.departed = set()
+        self.broken = False
+        self._kv = {}
+
+    def add_unit(self, unit, data=None):
+        self.data[unit] = dict(data or {})
+        self.departed.discard(unit)
+
+    def related_units(self, relation_id=None):
+        app = self.local.split("/")[0]
+        return sorted(
+            unit
+            for unit in self.data
+            if unit.split("/")[0] != app and unit not in self.departed
+        )
+
+    def relation_ids(self, endpoint_name=None):
+        return [] if self.broken else [self.relation_id]
+
+    def relation_get(self, attribute=None, unit=None, rid=None, app=None):
+        data = dict(self.data.get(unit or self.local, {}))
+        return data if attribute is None else data.get(attribute)
+
+    def relation_set(self, relation_id=None, relation_settings=None, **kwargs):
+        data = self.data[self.local]
+        for key, value in (relation_settings or {}).items():
+            if value in (None, ""):
+                data.pop(key, None)
+            else:
+                data[key] = value
+
+    def hook(self, endpoint_class, handle=None, unit=None, departed=None):
+        """
+        Run a hook as a `unit`, the CA by default, in which the endpoint is
+        passed to `handle`, and publish its data at the end.  If `departed`
+        is given, that unit departs in this hook.  The endpoint's joined
+        handler is run first, as the reactive framework would, and if either
+        raises, the hook fails without publishing or keeping anything.
+        """
+        self.local = unit or "easyrsa/0"
+        Path(hookenv.charm_dir()).mkdir(exist_ok=True)
+        unitdata._KV = self._kv.setdefault(self.local, unitdata.Storage(":memory:"))
+        self.hook_name = "certificates-relation-changed"
+        self.remote_unit = departed
+        if departed:
+            self.hook_name = "certificates-relation-departed"
+            self.departed.add(departed)
+        endpoint = endpoint_class("certificates", self.relation_ids())
+        Endpoint._endpoints["certificates"] = endpoint
+        endpoint._manage_departed()
+        for relation in endpoint.relations:
+            hookenv.atexit(relation._flush_data)
+        try:
+            if endpoint.is_joined:
+                endpoint.joined()
+            if handle:
+                handle(endpoint)
+        except Exception:
+            # the hook failed, so nothing it did is published or kept
+            del hookenv._atexit[:]
+            unitdata.kv().flush(save=False)
+            raise
+        hookenv._run_atexit()
+        unitdata.kv().flush()
+        return endpoint
+
+
+def sign_csr(csr):
+    """Issue a cert for a CSR, signed by a throwaway CA key."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    request = x509.load_pem_x509_csr(csr.encode("utf8"))
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(request.subject)
+        .issuer_name(request.subject)
+        .public_key(request.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(ec.generate_private_key(ec.SECP256R1()), hashes.SHA256())
+    )
+    return cert.public_bytes(serialization.Encoding.PEM).decode("utf8")
+
+
+@pytest.fixture()
+def juju(tmp_path):
+    juju = Juju(tmp_path)
+    with mock.patch.multiple(
+        hookenv,
+        charm_dir=lambda: str(tmp_path / juju.local.replace("/", "-")),
+        local_unit=lambda: juju.local,
+        application_name=lambda: juju.local.split("/")[0],
+        hook_name=lambda: juju.hook_name,
+        relation_id=lambda *args: juju.relation_id,
+        remote_unit=lambda: juju.remote_unit,
+        relation_ids=juju.relation_ids,
+        related_units=juju.related_units,
+        relation_get=juju.relation_get,
+        relation_set=juju.relation_set,
+        log=mock.DEFAULT,
+    ), mock.patch.object(unitdata, "_KV", None), mock.patch.dict(Endpoint._endpoints):
+        yield juju
@@ -0,0 +1,405 @@
+import asyncio
+import json
+import os
+import stat
+import unittest.mock as mock
+
+import pytest
+from charmhelpers.core import unitdata
+from tls_certificates.provides import TlsProvides
+from tls_certificates.tls_certificates_common import AsyncSigner
+
+
+class FakeRequest:
+    def __init__(self, common_name, csr=None):
+        self._index_key = ("certificates:1", "test_0", "server", common_name)
+        self.cert_type = "server"
+        self.common_name = common_name
+        self.csr = csr
+        self.set_cert = mock.MagicMock()
+
+
+class LocalSigner(AsyncSigner):
+    """Stand-in for an external CA, which signs every request locally."""
+
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.active = self.most_active = 0
+
+    async def sign(self, request):
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+        await asyncio.sleep(0)
+        self.active -= 1
+        if request.common_name in self.fail:
+            raise RuntimeError("rejected")
+        if request.common_name == "malformed":
+            return "CERT-ONLY"
+        if request.csr:
+            return "SIGNED-" + request.common_name
+        return "CERT-" + request.common_name, "KEY-" + request.common_name
+
+
+def sign(endpoint):
+    """Sign all of the new requests, with certs named after their SANs."""
+    for request in endpoint.new_requests:
+        request.set_cert("CERT:" + ",".join(request.sans), "KEY")
+
+
+@pytest.fixture()
+def provides():
+    requests = [FakeRequest("server-{}".format(i)) for i in range(10)]
+    requests.append(FakeRequest("csr", csr="CSR"))
+    endpoint = TlsProvides("certificates")
+    with mock.patch.object(
+        TlsProvides, "new_requests", new_callable=mock.PropertyMock
+    ) as new_requests, mock.patch.object(
+        TlsProvides, "_pending_requests", new_callable=mock.PropertyMock
+    ) as pending, mock.patch(
+        "charmhelpers.core.hookenv.log"
+    ):
+        new_requests.return_value = requests
+        pending.return_value = {request._index_key: request for request in requests}
+        yield endpoint, requests
+
+
+def test_async_signer_is_abstract():
+    with pytest.raises(TypeError):
+        AsyncSigner()
+
+
+def test_process_new_requests_async(provides):
+    endpoint, requests = provides
+    assert endpoint.process_new_requests_async(LocalSigner()) == []
+    requests[0].set_cert.assert_called_once_with("CERT-server-0", "KEY-server-0")
+    requests[-1].set_cert.assert_called_once_with("SIGNED-csr", None)
+
+
+def test_process_new_requests_async_partial_failure(provides):
+    endpoint, requests = provides
+    requests[2].common_name = "malformed"
+    requests[4].set_cert.side_effect = ValueError("unpublishable")
+    errors = endpoint.process_new_requests_async(LocalSigner(fail=["server-1"]))
+    assert [request for request, _ in errors] == [
+        requests[1],
+        requests[2],
+        requests[4],
+    ]
+    assert isinstance(errors[0][1], RuntimeError)
+    # the others are all still published
+    assert sum(request.set_cert.called for request in requests) == 9
+
+
+def test_process_new_requests_async_concurrency(provides):
+    endpoint, requests = provides
+    signer = LocalSigner()
+    endpoint.process_new_requests_async(signer, concurrency=3)
+    assert signer.most_active == 3
+    assert all(request.set_cert.called for request in requests)
+
+
+def test_removed_certs_are_requested_again(juju):
+    juju.add_unit(
+        "test/0",
+        {
+            "unit_name": "test_0",
+            "cert_requests": json.dumps({"server-0": {"sans": []}}),
+        },
+    )
+    juju.hook(TlsProvides, sign)
+    assert "test_0.processed_requests" in juju.data["easyrsa/0"]
+    assert juju.hook(TlsProvides).new_requests == []
+
+    # the charm removes the published cert other than by setting a new one
+    def remove(endpoint):
+        endpoint.relations[0].to_publish_raw["test_0.processed_requests"] = None
+
+    juju.hook(TlsProvides, remove)
+    (request,) = juju.hook(TlsProvides).new_requests
+    assert request.common_name == "server-0"
+
+
+def test_departed_units_are_pruned(juju):
+    for i in range(2):
+        juju.add_unit(
+            "test/{}".format(i),
+            {
+                "unit_name": "test_{}".format(i),
+                "cert_requests": json.dumps({"server-0": {"sans": []}}),
+            },
+        )
+    juju.hook(TlsProvides, sign)
+    published = juju.data["easyrsa/0"]
+    assert "test_1.processed_requests" in published
+
+    juju.hook(TlsProvides, TlsProvides.departed, departed="test/1")
+    assert not any(key.startswith("test_1.") for key in published)
+    assert "test_0.processed_requests" in published
+
+    # the relation is dropped from the endpoint when its last unit departs
+    endpoint = juju.hook(TlsProvides, TlsProvides.departed, departed="test/0")
+    assert endpoint.relations == []
+    assert not any(key.startswith("test_0.") for key in published)
+    # the departed units are left for the charm, but not pruned again
+    assert len(endpoint.all_departed_units) == 2
+    assert juju.hook(TlsProvides).prune_departed_units() == 0
+
+
+def test_withdrawn_certs_are_pruned(juju):
+    for i in range(2):
+        juju.add_unit(
+            "test/{}".format(i),
+            {
+                "unit_name": "test_{}".format(i),
+                "cert_requests": json.dumps(
+                    {"server-0": {"sans": []}, "server-1": {"sans": []}}
+                ),
+                "application_cert_requests": json.dumps(
+                    {"host-{}".format(i): {"sans": []}}
+                ),
+            },
+        )
+    juju.hook(TlsProvides, sign)
+    published = juju.data["easyrsa/0"]
+
+    juju.data["test/0"]["cert_requests"] = json.dumps({"server-0": {"sans": []}})
+    juju.data["test/0"]["application_cert_requests"] = ""
+    # only the shared application cert is requested again, for fewer names
+    (request,) = juju.hook(TlsProvides).new_requests
+    assert request.cert_type == "application"
+    assert sorted(json.loads(published["test_0.processed_requests"])) == ["server-0"]
+    assert sorted(json.loads(published["test_1.processed_requests"])) == [
+        "server-0",
+        "server-1",
+    ]
+    # the application cert is shared by every unit while any requests it
+    assert "test_0.processed_application_requests" in published
+
+    juju.data["test/1"]["application_cert_requests"] = ""
+    assert juju.hook(TlsProvides).new_requests == []
+    assert "test_0.processed_application_requests" not in published
+    assert "test_1.processed_application_requests" not in published
+
+
+def test_application_cert_is_signed_once(juju):
+    for i, host in enumerate(["host-a", "host-b"]):
+        juju.add_unit(
+            "test/{}".format(i),
+            {
+                "unit_name": "test_{}".format(i),
+                "application_cert_requests": json.dumps({host: {"sans": ["app"]}}),
+            },
+        )
+    signed = []
+
+    def sign_app(endpoint):
+        for request in endpoint.new_application_requests:
+            signed.append(request.common_name)
+            request.set_cert("CERT", "KEY")
+
+    juju.hook(TlsProvides, sign_app)
+    assert signed
+    # the shared cert isn't reissued in later hooks
+    signed.clear()
+    for _ in range(3):
+        juju.hook(TlsProvides, sign_app)
+    assert signed == []
+    published = juju.data["easyrsa/0"]
+    assert (
+        published["test_0.processed_application_requests"]
+        == published["test_1.processed_application_requests"]
+    )
+
+
+def test_unchanged_units_are_not_decoded(juju):
+    for i in range(4):
+        requests = {"server-{}".format(n): {"sans": []} for n in range(50)}
+        juju.add_unit(
+            "test/{}".format(i),
+            {"unit_name": "test_{}".format(i), "cert_requests": json.dumps(requests)},
+        )
+    juju.hook(TlsProvides, sign)
+    # the certs which were just published are checked once
+    assert juju.hook(TlsProvides).new_requests == []
+    with mock.patch("json.loads", wraps=json.loads) as loads:
+        assert juju.hook(TlsProvides).new_requests == []
+    assert not [call for call in loads.call_args_list if '"cert"' in call.args[0]]
+
+    # the published certs of a unit are decoded once when they change
+    def remove(endpoint):
+        certs = endpoint._published_certs(
+            endpoint.relations[0], "test_1.processed_requests"
+        )
+        del certs["server-0"]
+        endpoint.relations[0].to_publish["test_1.processed_requests"] = certs
+
+    juju.hook(TlsProvides, remove)
+    with mock.patch("json.loads", wraps=json.loads) as loads:
+        (request,) = juju.hook(TlsProvides).new_requests
+    assert (request.unit_name, request.common_name) == ("test_1", "server-0")
+    assert len([call for call in loads.call_args_list if '"cert"' in call.args[0]]) == 1
+
+
+def test_journal_is_private(juju):
+    juju.add_unit(
+        "test/0",
+        {
+            "unit_name": "test_0",
+            "cert_requests": json.dumps({"server-0": {"sans": ["10.0.0.1"]}}),
+        },
+    )
+    umask = os.umask(0o022)
+    try:
+        juju.hook(TlsProvides, sign)
+    finally:
+        os.umask(umask)
+    journal = juju.tmp_path / "easyrsa-0" / ".tls-issuance-journal.db"
+    assert stat.S_IMODE(journal.stat().st_mode) == 0o600
+
+
+def add_units(juju, count):
+    for i in range(count):
+        juju.add_unit(
+            "test/{}".format(i),
+            {
+                "unit_name": "test_{}".format(i),
+                "cert_requests": json.dumps({"server-0": {"sans": []}}),
+            },
+        )
+
+
+def test_ca_rotation(juju):
+    add_units(juju, 10)
+    juju.hook(TlsProvides, lambda endpoint: (endpoint.set_ca("OLD"), sign(endpoint)))
+    published = juju.data["easyrsa/0"]
+
+    def rotate(endpoint):
+        endpoint.rotate_ca("NEW", chain="CHAIN", wave_percent=20)
+
+    endpoint = juju.hook(TlsProvides, rotate)
+    # both CAs are trusted until every cert has been reissued
+    assert published["ca"] == "OLD\nNEW"
+    assert "chain" not in published
+    assert endpoint.ca_rotation == {"done": 0, "total": 10}
+
+    waves = []
+
+    def sign_wave(endpoint):
+        waves.append(sorted(r.unit_name for r in endpoint.new_requests))
+        sign(endpoint)
+
+    while juju.hook(TlsProvides).ca_rotation is not None:
+        assert published["ca"] == "OLD\nNEW"
+        juju.hook(TlsProvides, sign_wave)
+    # 20% of the units in each hook, each of them once
+    assert [len(wave) for wave in waves] == [2] * 5
+    assert sorted(sum(waves, [])) == ["test_{}".format(i) for i in range(10)]
+    assert published["ca"] == "NEW"
+    assert published["chain"] == "CHAIN"
+
+
+def test_ca_rotation_waves(juju):
+    add_units(juju, 10)
+    juju.hook(TlsProvides, lambda endpoint: (endpoint.set_ca("OLD"), sign(endpoint)))
+    juju.hook(TlsProvides, lambda endpoint: endpoint.rotate_ca("NEW", wave_size=3))
+
+    sizes = []
+    for done in (3, 6, 9, 10):
+        endpoint = juju.hook(TlsProvides)
+        sizes.append(len(endpoint.new_requests))
+        sign(endpoint)
+        # progress is kept across hooks
+        assert juju.hook(TlsProvides).ca_rotation in (
+            {"done": done, "total": 10},
+            None,
+        )
+    assert sizes == [3, 3, 3, 1]
+    assert juju.data["easyrsa/0"]["ca"] == "NEW"
+    assert juju.hook(TlsProvides).new_requests == []
+
+
+def test_ca_rotation_is_superseded(juju):
+    add_units(juju, 4)
+    juju.hook(TlsProvides, lambda endpoint: (endpoint.set_ca("OLD"), sign(endpoint)))
+    juju.hook(TlsProvides, lambda endpoint: endpoint.rotate_ca("NEW", wave_size=2))
+    juju.hook(TlsProvides, sign)
+    assert juju.hook(TlsProvides).ca_rotation == {"done": 2, "total": 4}
+
+    # the certs of the superseded CA aren't trusted any more than the old ones
+    endpoint = juju.hook(TlsProvides, lambda e: e.rotate_ca("NEWER", wave_size=2))
+    assert juju.data["easyrsa/0"]["ca"] == "OLD\nNEWER"
+    assert endpoint.ca_rotation == {"done": 0, "total": 4}
+    for _ in range(2):
+        juju.hook(TlsProvides, sign)
+    assert juju.hook(TlsProvides).ca_rotation is None
+    assert juju.data["easyrsa/0"]["ca"] == "NEWER"
+
+
+def test_ca_is_published_once(juju):
+    juju.add_unit("test/0", {"unit_name": "test_0"})
+    updated = []
+
+    def set_ca(ca):
+        def handle(endpoint):
+            updated.append(endpoint.set_ca(ca))
+
+        return handle
+
+    juju.hook(TlsProvides, set_ca("CA"))
+    juju.hook(TlsProvides, set_ca("CA"))
+    juju.hook(TlsProvides, set_ca("CA2"))
+    assert updated == [1, 0, 1]
+    assert juju.data["easyrsa/0"]["ca"] == "CA2"
+
+    # a new relation is sent the current CA
+    juju.relation_id = "certificates:2"
+    juju.hook(TlsProvides, set_ca("CA2"))
+    assert updated[-1] == 1
+
+
+def test_failed_hook_is_replayed(juju):
+    add_units(juju, 2)
+    signed = []
+
+    def sign_and_fail(endpoint):
+        for request in endpoint.new_requests:
+            signed.append(request.unit_name)
+            request.set_cert("CERT-" + request.unit_name, "KEY")
+        raise RuntimeError("hook failed")
+
+    with pytest.raises(RuntimeError):
+        juju.hook(TlsProvides, sign_and_fail)
+    published = juju.data["easyrsa/0"]
+    assert "test_0.processed_requests" not in published
+
+    # the certs are published from the journal rather than signed again
+    assert juju.hook(TlsProvides).new_requests == []
+    assert sorted(signed) == ["test_0", "test_1"]
+    for unit_name in signed:
+        certs = json.loads(published["{}.processed_requests".format(unit_name)])
+        assert certs["server-0"]["cert"] == "CERT-" + unit_name
+
+    # only the fingerprints are kept once the certs are seen to be published
+    juju.hook(TlsProvides)
+    path = juju.tmp_path / "easyrsa-0" / ".tls-issuance-journal.db"
+    entries = unitdata.Storage(str(path)).getrange("certificates.journal.")
+    assert len(entries) == 2
+    for entry in entries.values():
+        assert entry["status"] == "published"
+        assert "key" not in entry
+
+
+def test_journal_entries_of_changed_requests_are_dropped(juju):
+    add_units(juju, 1)
+
+    def sign_and_fail(endpoint):
+        sign(endpoint)
+        raise RuntimeError("hook failed")
+
+    with pytest.raises(RuntimeError):
+        juju.hook(TlsProvides, sign_and_fail)
+    juju.data["test/0"]["cert_requests"] = json.dumps({"server-0": {"sans": ["a"]}})
+    (request,) = juju.hook(TlsProvides).new_requests
+    assert request.sans == ["a"]
+    path = juju.tmp_path / "easyrsa-0" / ".tls-issuance-journal.db"
+    assert unitdata.Storage(str(path)).getrange("certificates.journal.") == {}
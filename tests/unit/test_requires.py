@@ -0,0 +1,119 @@
+import hashlib
+import unittest.mock as mock
+
+from conftest import sign_csr
+from tls_certificates.provides import TlsProvides
+from tls_certificates.requires import TlsRequires
+
+
+def sign_csrs(endpoint):
+    """Sign the CSRs of all of the new requests."""
+    for request in endpoint.new_requests:
+        request.set_cert(sign_csr(request.csr))
+
+
+def test_csr_key_replaced(juju):
+    juju.add_unit("test/0")
+
+    def request(key_type):
+        def handle(endpoint):
+            endpoint.set_csr_mode()
+            endpoint.request_client_cert("proxy", [], key_type=key_type)
+
+        return handle
+
+    juju.hook(TlsRequires, request(None), unit="test/0")
+    juju.hook(TlsProvides, sign_csrs)
+    (old,) = juju.hook(TlsRequires, request("ecdsa"), unit="test/0").client_certs
+
+    # until the CA signs the new CSR, the cert is paired with the old key
+    (cert,) = juju.hook(TlsRequires, unit="test/0").client_certs
+    assert (cert.cert, cert.key) == (old.cert, old.key)
+    juju.hook(TlsProvides, sign_csrs)
+    (new,) = juju.hook(TlsRequires, unit="test/0").client_certs
+    assert new.key != old.key
+    assert "BEGIN PRIVATE KEY" in new.key
+
+
+def test_unchanged_requests_keep_their_stamp(juju):
+    juju.add_unit("test/0")
+
+    def request(endpoint):
+        endpoint.request_server_cert("server-0", ("a", "b"))
+        endpoint.request_server_cert("server-1", ("a", "b"))
+        endpoint.request_client_cert("client", ("a", "b"))
+
+    juju.hook(TlsRequires, request, unit="test/0")
+    published = dict(juju.data["test/0"])
+    juju.hook(TlsRequires, request, unit="test/0")
+    assert juju.data["test/0"] == published
+
+
+def test_cert_changes(juju):
+    juju.add_unit("test/0")
+
+    def sign(endpoint):
+        for request in endpoint.new_requests:
+            request.set_cert("CERT:" + ",".join(request.sans), "KEY")
+
+    def request(sans):
+        def handle(endpoint):
+            for cn in sans:
+                endpoint.request_client_cert(cn, sans[cn])
+
+        return handle
+
+    juju.hook(TlsRequires, request({"a": ["a"], "b": ["b"]}), unit="test/0")
+    juju.hook(TlsProvides, sign)
+    changes = juju.hook(TlsRequires, unit="test/0").changed_client_certs
+    assert sorted(changes.added) == ["a", "b"]
+    assert (changes.modified, changes.removed) == ({}, [])
+
+    # nothing has changed since the previous hook
+    endpoint = juju.hook(TlsRequires, unit="test/0")
+    assert not endpoint.changed_client_certs
+    assert sorted(endpoint.client_certs_map) == ["a", "b"]
+
+    def update(endpoint):
+        endpoint.request_client_cert("b", ["b", "c"])
+        endpoint.withdraw_cert("a")
+
+    juju.hook(TlsRequires, update, unit="test/0")
+    juju.hook(TlsProvides, sign)
+    changes = juju.hook(TlsRequires, unit="test/0").changed_client_certs
+    assert changes.added == {}
+    assert changes.modified["b"].cert == "CERT:b,c"
+    assert changes.removed == ["a"]
+    assert not juju.hook(TlsRequires, unit="test/0").changed_client_certs
+
+
+def test_unchanged_certs_are_not_decoded(juju):
+    juju.add_unit("test/0")
+
+    def sign(endpoint):
+        for request in endpoint.new_requests:
+            request.set_cert("CERT:" + ",".join(request.sans), "KEY")
+
+    juju.hook(TlsRequires, lambda e: e.request_client_cert("a", ["a"]), unit="test/0")
+    juju.hook(TlsProvides, sign)
+    published = juju.data["easyrsa/0"]
+    content = "\n".join(
+        ["", "", "", published["test_0.processed_client_requests"], "", ""]
+    )
+    digest = hashlib.sha256(content.encode("utf8")).hexdigest()[:16]
+    assert published["test_0.digest"] == digest
+    juju.hook(TlsRequires, unit="test/0")
+
+    client_certs = mock.PropertyMock(return_value=[])
+    with mock.patch.object(TlsRequires, "client_certs", client_certs):
+        juju.hook(TlsRequires, unit="test/0")
+        assert not client_certs.called
+
+        # a new cert changes the digest
+        juju.hook(
+            TlsRequires, lambda e: e.request_client_cert("a", ["b"]), unit="test/0"
+        )
+        juju.hook(TlsProvides, sign)
+        assert published["test_0.digest"] != digest
+        juju.hook(TlsRequires, unit="test/0")
+        assert client_certs.called
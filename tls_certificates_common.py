@@ -1,17 +1,131 @@
-from charms.reactive import clear_flag, is_data_changed, data_changed
+import abc
+import hashlib
+import ipaddress
+import json
+import os
+import time
+
+from charms.reactive import is_data_changed, data_changed
+
+# supported key types, and their default size
+KEY_TYPES = {
+    "rsa": 2048,
+    "ecdsa": 256,
+    "ed25519": None,
+}
+
+
+def key_options(key_type=None, key_size=None):
+    """
+    Validate the optional key type and size of a request, returning the fields
+    to include in it.
+    """
+    if key_type is None:
+        if key_size is not None:
+            raise ValueError("key_size requires a key_type")
+        return {}
+    if key_type not in KEY_TYPES:
+        raise ValueError("Unknown key_type: {}".format(key_type))
+    options = {"key_type": key_type}
+    if key_size is not None:
+        options["key_size"] = int(key_size)
+    return options
+
+
+# fields which stamp when a request was made, and so aren't part of its content
+STAMP_FIELDS = ("requested_at", "request_seq")
+
+# upper bounds, in seconds, of the buckets of issuance latency histograms
+LATENCY_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 3600)
+
+
+def stamp_request(request, previous, next_seq):
+    """
+    Return the `request` stamped with the time it was made and a sequence
+    number, keeping the stamp of the `previous` request if it is otherwise
+    unchanged.  The `next_seq` callable allocates a new sequence number.
+    """
+    # compared as it will be published, since the previous request was decoded
+    request = json.loads(json.dumps(request))
+    previous = dict(previous or {})
+    stamp = {field: previous.pop(field, None) for field in STAMP_FIELDS}
+    if previous != request or None in stamp.values():
+        stamp = {"requested_at": time.time(), "request_seq": next_seq()}
+    return dict(request, **stamp)
+
+
+def record_latency(histogram, seconds):
+    """
+    Add a latency to a `histogram` dict, with the count of latencies in each
+    of the `LATENCY_BUCKETS` by their upper bound, and their total count and
+    sum.
+    """
+    seconds = max(0.0, seconds)
+    bucket = next((str(b) for b in LATENCY_BUCKETS if seconds <= b), "+Inf")
+    buckets = histogram.setdefault("buckets", {})
+    buckets[bucket] = buckets.get(bucket, 0) + 1
+    histogram["count"] = histogram.get("count", 0) + 1
+    histogram["sum"] = histogram.get("sum", 0.0) + seconds
+    return histogram
+
+
+def canonicalize_sans(sans, common_name=None):
+    """
+    Return the canonical form of a list of subject alternative names, so that
+    equivalent lists compare equal.
+
+    DNS names are lower-cased without any trailing dot, IP addresses are
+    normalized, and duplicates removed.  If the `common_name` is given, it is
+    folded out of the result, since whether it is repeated as a SAN doesn't
+    change what the request is for.
+    """
+    canonical = set()
+    for san in sans or []:
+        san = str(san).strip()
+        try:
+            san = str(ipaddress.ip_address(san))
+        except ValueError:
+            san = san.lower().rstrip(".")
+        if san:
+            canonical.add(san)
+    if common_name:
+        canonical.discard(str(common_name).strip().lower().rstrip("."))
+    return sorted(canonical)
 
 
 class CertificateRequest(dict):
-    def __init__(self, unit, cert_type, cert_name, common_name, sans):
+    def __init__(
+        self,
+        unit,
+        cert_type,
+        cert_name,
+        common_name,
+        sans,
+        csr=None,
+        key_type=None,
+        key_size=None,
+        requested_at=None,
+        request_seq=None,
+    ):
         self._unit = unit
         self._cert_type = cert_type
+        self._requested_sans = sans
         super().__init__(
             {
                 "certificate_name": cert_name,
                 "common_name": common_name,
-                "sans": sans,
+                "sans": canonicalize_sans(sans) if sans is not None else None,
             }
         )
+        if csr:
+            self["csr"] = csr
+        if key_type:
+            self["key_type"] = key_type
+            if key_size:
+                self["key_size"] = key_size
+        if requested_at is not None:
+            self["requested_at"] = float(requested_at)
+            self["request_seq"] = request_seq
 
     @property
     def _key(self):
@@ -19,7 +133,17 @@ class CertificateRequest(dict):
             (self._unit.relation.relation_id, self.unit_name, self.common_name)
         )
 
-    def resolve_unit_name(self, unit):
+    @property
+    def _index_key(self):
+        return (
+            self._unit.relation.relation_id,
+            self.unit_name,
+            self.cert_type,
+            self.common_name,
+        )
+
+    @staticmethod
+    def resolve_unit_name(unit):
         """Return name of unit associated with this request.
 
         unit_name should be provided in the relation data to ensure
@@ -72,8 +196,95 @@ class CertificateRequest(dict):
 
     @property
     def sans(self):
+        """
+        Canonical list of the subject alternative names requested.
+        """
         return self["sans"]
 
+    @property
+    def csr(self):
+        """
+        The certificate signing request, if the requirer generated its own key.
+
+        When this is set, only the signed cert should be passed to `set_cert()`.
+        """
+        return self.get("csr")
+
+    @property
+    def key_type(self):
+        """
+        Type of private key requested, 'rsa', 'ecdsa' or 'ed25519', or None if
+        the requirer has no preference.
+        """
+        return self.get("key_type")
+
+    @property
+    def key_size(self):
+        """
+        Size of the private key requested, in bits for 'rsa' or as the curve
+        size for 'ecdsa', or None for the default size of the `key_type`.
+        """
+        return self.get("key_size")
+
+    @property
+    def requested_at(self):
+        """
+        Time at which the requirer made this request, as seconds since the
+        epoch, or None for requirers which don't stamp their requests.
+        """
+        return self.get("requested_at")
+
+    @property
+    def request_seq(self):
+        """
+        Sequence number of this request amongst those made by the requirer.
+        """
+        return self.get("request_seq")
+
+    @property
+    def queue_age(self):
+        """
+        Seconds since the requirer made this request, or None if unknown.
+        """
+        if self.requested_at is None:
+            return None
+        return max(0.0, time.time() - self.requested_at)
+
+    @property
+    def _raw_sans(self):
+        """
+        The subject alternative names as they were requested.
+        """
+        return self._requested_sans
+
+    def _fingerprint_of(self, sans):
+        options = {
+            key: self[key] for key in ("csr", "key_type", "key_size") if key in self
+        }
+        if not options:
+            return sans
+        return dict(options, sans=sans)
+
+    @property
+    def _fingerprint(self):
+        """
+        The request data which requires a new cert to be issued if changed.
+        """
+        return self._fingerprint_of(canonicalize_sans(self.sans, self.common_name))
+
+    @property
+    def _is_unchanged(self):
+        """
+        Whether the request is the same as when its cert was last set.
+
+        Fingerprints recorded before SANs were canonicalized are accepted too,
+        so that upgrading doesn't reissue every cert.
+        """
+        if not is_data_changed(self._key, self._fingerprint):
+            return True
+        legacy = self._fingerprint_of(sorted(set(self._raw_sans or [])))
+        return not is_data_changed(self._key, legacy)
+
     @property
     def _publish_key(self):
         if self.cert_type == "server":
@@ -110,22 +321,26 @@ class CertificateRequest(dict):
             cert = tpr[self._server_cert_key]
             key = tpr[self._server_key_key]
         else:
-            tp = self._unit.relation.to_publish
-            certs_data = tp.get(self._publish_key, {})
+            rel = self._unit.relation
+            certs_data = rel.endpoint._published_certs(rel, self._publish_key)
             cert_data = certs_data.get(self.common_name, {})
             cert = cert_data.get("cert")
             key = cert_data.get("key")
-        if cert and key:
+        if cert and (key or self.csr):
             return Certificate(self.cert_type, self.common_name, cert, key)
         return None
 
     @property
     def is_handled(self):
-        has_cert = self.cert is not None
-        same_sans = not is_data_changed(self._key, sorted(set(self.sans or [])))
-        return has_cert and same_sans
+        return self.cert is not None and self._is_unchanged
 
-    def set_cert(self, cert, key):
+    def set_cert(self, cert, key=None):
+        """
+        Publish the cert and key for this request.
+
+        For requests with a `csr`, the key is kept by the requirer and only
+        the signed cert should be given.
+        """
         rel = self._unit.relation
         if self._is_top_level_server_cert:
             # backwards compatibility; if this is the cert that was requested
@@ -138,19 +353,13 @@ class CertificateRequest(dict):
                 }
             )
         else:
-            data = rel.to_publish.get(self._publish_key, {})
-            data[self.common_name] = {
-                "cert": cert,
-                "key": key,
-            }
+            data = rel.endpoint._published_certs(rel, self._publish_key)
+            data[self.common_name] = {"cert": cert}
+            if key:
+                data[self.common_name]["key"] = key
             rel.to_publish[self._publish_key] = data
-        if not rel.endpoint.new_server_requests:
-            clear_flag(
-                rel.endpoint.expand_name("{endpoint_name}.server.cert.requested")
-            )
-        if not rel.endpoint.new_requests:
-            clear_flag(rel.endpoint.expand_name("{endpoint_name}.certs.requested"))
-        data_changed(self._key, sorted(set(self.sans or [])))
+        data_changed(self._key, self._fingerprint)
+        rel.endpoint._request_handled(self)
 
 
 class ApplicationCertificateRequest(CertificateRequest):
@@ -182,8 +391,8 @@ class ApplicationCertificateRequest(CertificateRequest):
         :rtype: Certificate or None
         """
         cert, key = None, None
-        tp = self._unit.relation.to_publish
-        certs_data = tp.get(self._publish_key, {})
+        rel = self._unit.relation
+        certs_data = rel.endpoint._published_certs(rel, self._publish_key)
         cert_data = certs_data.get("app_data", {})
         cert = cert_data.get("cert")
         key = cert_data.get("key")
@@ -198,9 +407,7 @@ class ApplicationCertificateRequest(CertificateRequest):
         :returns: If the cert has been handled
         :rtype: bool
         """
-        has_cert = self.cert is not None
-        same_sans = not is_data_changed(self._key, sorted(set(self.sans or [])))
-        return has_cert and same_sans
+        return self.cert is not None and self._is_unchanged
 
     @property
     def sans(self):
@@ -212,13 +419,27 @@ class ApplicationCertificateRequest(CertificateRequest):
         :returns: List of sans
         :rtype: List[str]
         """
+        return canonicalize_sans(self._raw_sans)
+
+    @property
+    def _fingerprint(self):
+        """
+        The request data which requires a new cert to be issued if changed.
+
+        The SANs are shared by the requests of every unit, so unlike other
+        requests, the common name of this unit's request is kept in them.
+        """
+        return self._fingerprint_of(self.sans)
+
+    @property
+    def _raw_sans(self):
         _sans = []
         for unit in self._unit.relation.units:
             reqs = unit.received["application_cert_requests"] or {}
             for cn, req in reqs.items():
                 _sans.append(cn)
                 _sans.extend(req["sans"])
-        return sorted(list(set(_sans)))
+        return _sans
 
     @property
     def _request_key(self):
@@ -262,17 +483,35 @@ class ApplicationCertificateRequest(CertificateRequest):
         rel = self._unit.relation
         for unit in self._unit.relation.units:
             pub_key = self.derive_publish_key(unit=unit)
-            data = rel.to_publish.get(pub_key, {})
+            data = rel.endpoint._published_certs(rel, pub_key)
             data["app_data"] = {
                 "cert": cert,
                 "key": key,
             }
             rel.to_publish[pub_key] = data
-        if not rel.endpoint.new_application_requests:
-            clear_flag(
-                rel.endpoint.expand_name("{endpoint_name}.application.certs.requested")
-            )
-        data_changed(self._key, sorted(set(self.sans or [])))
+        data_changed(self._key, self._fingerprint)
+        rel.endpoint._request_handled(self)
+
+
+class AsyncSigner(abc.ABC):
+    """
+    Interface for signing backends, such as an external CA service, which can
+    sign many requests concurrently.
+
+    Used with `TlsProvides.process_new_requests_async()`.
+
+    [CertificateRequest]: common.md#tls_certificates_common.CertificateRequest
+    """
+
+    @abc.abstractmethod
+    async def sign(self, request):
+        """
+        Issue the cert for a [CertificateRequest][].
+
+        For requests with a `csr`, this should return just the signed cert.
+        Otherwise, it should return a `(cert, key)` tuple.  Any exception
+        raised is collected as the error of that request.
+        """
 
 
 class Certificate(dict):
@@ -308,3 +547,239 @@ class Certificate(dict):
     @property
     def key(self):
         return self["key"]
+
+    @property
+    def fingerprint(self):
+        """
+        Digest of the cert and key, used to detect when a cert is reissued.
+        """
+        content = "{}\n{}".format(self.cert, self.key)
+        return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+
+class CertificateChanges(dict):
+    """
+    Represents the certificates which changed since they were last seen.
+
+    The ``added`` and ``modified`` values are mappings of [Certificate][]
+    instances by their `common_name`, while ``removed`` is a list of the
+    common names which are no longer available.  They can be accessed either
+    as properties or as the contents of the dict.
+
+    [Certificate]: common.md#tls_certificates_common.Certificate
+    [names]: common.md#tls_certificates_common.CertificateChanges.names
+    """
+
+    def __init__(self, added=None, modified=None, removed=None):
+        super().__init__(
+            {
+                "added": added or {},
+                "modified": modified or {},
+                "removed": removed or [],
+            }
+        )
+
+    def __bool__(self):
+        return bool(self.added or self.modified or self.removed)
+
+    @classmethod
+    def from_fingerprints(cls, fingerprints, certs_map):
+        """
+        Compare the [Certificate][] instances in `certs_map` against a
+        previously seen mapping of `fingerprints` by common name.
+        """
+        added, modified = {}, {}
+        for common_name, cert in certs_map.items():
+            if common_name not in fingerprints:
+                added[common_name] = cert
+            elif fingerprints[common_name] != cert.fingerprint:
+                modified[common_name] = cert
+        removed = sorted(cn for cn in fingerprints if cn not in certs_map)
+        return cls(added, modified, removed)
+
+    @classmethod
+    def from_names(cls, names, certs_map):
+        """
+        Rebuild the changes from the common names stored by [names][],
+        resolving them against the [Certificate][] instances in `certs_map`.
+        """
+        names = names or {}
+        return cls(
+            {cn: certs_map[cn] for cn in names.get("added", []) if cn in certs_map},
+            {cn: certs_map[cn] for cn in names.get("modified", []) if cn in certs_map},
+            list(names.get("removed", [])),
+        )
+
+    @property
+    def names(self):
+        """
+        JSON-serializable form of these changes, by common name only.
+        """
+        return {
+            "added": sorted(self.added),
+            "modified": sorted(self.modified),
+            "removed": list(self.removed),
+        }
+
+    @property
+    def added(self):
+        return self["added"]
+
+    @property
+    def modified(self):
+        return self["modified"]
+
+    @property
+    def removed(self):
+        return self["removed"]
+
+
+def generate_private_key(key_type="rsa", key_size=None):
+    """
+    Generate a new private key of the given type and size, returned as PEM.
+
+    This requires the `cryptography` package to be available to the charm.
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+    key_options(key_type, key_size)
+    key_size = key_size or KEY_TYPES[key_type]
+    if key_type == "rsa":
+        key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    elif key_type == "ecdsa":
+        curves = {256: ec.SECP256R1, 384: ec.SECP384R1, 521: ec.SECP521R1}
+        if key_size not in curves:
+            raise ValueError("Unsupported ecdsa key_size: {}".format(key_size))
+        key = ec.generate_private_key(curves[key_size]())
+    else:
+        key = ed25519.Ed25519PrivateKey.generate()
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode("utf8")
+
+
+def generate_csr(private_key, common_name, sans=None):
+    """
+    Generate a certificate signing request, returned as PEM, for the given
+    common name and alternative names, signed by the given PEM private key.
+
+    This requires the `cryptography` package to be available to the charm.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+    from cryptography.x509.oid import NameOID
+
+    key = serialization.load_pem_private_key(private_key.encode("utf8"), None)
+    names = []
+    for san in sans or []:
+        try:
+            names.append(x509.IPAddress(ipaddress.ip_address(san)))
+        except ValueError:
+            names.append(x509.DNSName(san))
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    builder = x509.CertificateSigningRequestBuilder().subject_name(subject)
+    if names:
+        builder = builder.add_extension(
+            x509.SubjectAlternativeName(names), critical=False
+        )
+    # Ed25519 keys sign without a separate digest
+    digest = None if isinstance(key, ed25519.Ed25519PrivateKey) else hashes.SHA256()
+    csr = builder.sign(key, digest)
+    return csr.public_bytes(serialization.Encoding.PEM).decode("utf8")
+
+
+CERTS_INDEX = ".certs-index.json"
+
+
+def _content_hash(content):
+    return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+
+def write_certs(certs, directory):
+    """
+    Write the cert and key of each [Certificate][] to `directory`, as
+    `{common_name}.crt` and `{common_name}.key`.
+
+    Only the files whose content changed since the previous call are written.
+    Each is written to a temporary file and synced to disk, then they are
+    all atomically renamed into place and the directory is synced once.
+    The content hashes are kept in an index file in `directory` so unchanged
+    files don't need to be read.
+
+    Returns the list of paths which were written, so that only the services
+    using those files need to be reloaded.
+
+    Example usage:
+
+    ```python
+    @when('tls.certs.changed')
+    def update_certs():
+        tls = endpoint_from_flag('tls.certs.changed')
+        changed = write_certs(tls.server_certs, '/etc/myservice/tls')
+        if changed:
+            service_reload('myservice')
+        clear_flag('tls.certs.changed')
+    ```
+    """
+    os.makedirs(directory, exist_ok=True)
+    index_path = os.path.join(directory, CERTS_INDEX)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+
+    pending = []
+    for cert in certs:
+        name = cert.common_name.replace(os.sep, "_")
+        for filename, content, mode in (
+            (name + ".crt", cert.cert, 0o644),
+            (name + ".key", cert.key, 0o600),
+        ):
+            path = os.path.join(directory, filename)
+            digest = _content_hash(content)
+            if index.get(filename) == digest and os.path.exists(path):
+                continue
+            pending.append((path, content, mode))
+            index[filename] = digest
+    if not pending:
+        return []
+
+    pending.append((index_path, json.dumps(index, sort_keys=True), 0o644))
+    for path, content, mode in pending:
+        fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+    for path, _, _ in pending:
+        os.replace(path + ".tmp", path)
+    # the renames are made durable by a single sync of the directory
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return [path for path, _, _ in pending[:-1]]
+
+
+def cert_matches_key(cert, private_key):
+    """
+    Whether a PEM cert was issued for the public half of a PEM private key.
+
+    This requires the `cryptography` package to be available to the charm.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+
+    try:
+        public_key = x509.load_pem_x509_certificate(cert.encode("utf8")).public_key()
+        key = serialization.load_pem_private_key(private_key.encode("utf8"), None)
+    except ValueError:
+        return False
+    spki = (serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return public_key.public_bytes(*spki) == key.public_key().public_bytes(*spki)